@@ -0,0 +1,256 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+"""
+labeler achievements.
+
+every label event updates the labeler's UserStats row in the labeling transaction, then the
+RULES are checked against it and new awards go into UserAchievement. the scoreboard only reads
+those two tables.
+
+a label is judged when its image already had votes, it agrees if it matches the majority of
+those earlier votes (ties go to the lowest label id). `python -m api.achievements --rebuild`
+replays every label in order with the same logic
+"""
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+
+from api import cache
+from api.models import Achievement, Consensus, Labels, UserAchievement, UserStats
+
+# metric is labels, best_streak, accuracy or user. accuracy needs min_judged judged labels,
+# user rules are awarded to the named users
+Rule = namedtuple('Rule', 'name badge description metric threshold min_judged users')
+Rule.__new__.__defaults__ = (None, 0, ())
+
+RULES = (Rule('first_label', '🏷️', 'labeled an image', 'labels', 1),
+         Rule('labels_100', '💯', '100 labels', 'labels', 100),
+         Rule('labels_1000', '🏅', '1000 labels', 'labels', 1000),
+         Rule('labels_10000', '🏆', '10000 labels', 'labels', 10000),
+         Rule('streak_3', '🔥', 'labeled 3 days in a row', 'best_streak', 3),
+         Rule('streak_7', '📅', 'labeled 7 days in a row', 'best_streak', 7),
+         Rule('sharp_eye', '🎯', '90% agreement over 50 judged labels', 'accuracy', 0.9, 50),
+         # the original hand picked badges
+         Rule('cool', '😎', 'legacy badge', 'user', users=('jake',)),
+         Rule('nerd', '🤓', 'legacy badge', 'user', users=('MZimmerer',)))
+
+
+def met(rule, stats, name):
+    if rule.metric == 'user':
+        return name in rule.users
+    if rule.metric == 'accuracy':
+        judged = stats.judged or 0
+        return judged >= rule.min_judged and judged and (stats.agreed or 0) / judged >= rule.threshold
+    return (getattr(stats, rule.metric) or 0) >= rule.threshold
+
+
+def sync_rules(db):
+    """
+    make an Achievement row for every rule, and keep badge and description current
+    """
+    rows = cache.achievements.get(db, [r.name for r in RULES])
+    changed = False
+    for r in RULES:
+        row = rows.get(r.name)
+        if row is None:
+            db.add(Achievement(name=r.name, badge=r.badge, description=r.description))
+            changed = True
+        elif (row.badge, row.description) != (r.badge, r.description):
+            db.query(Achievement).filter(Achievement.id == row.id).update(
+                {Achievement.badge: r.badge, Achievement.description: r.description})
+            changed = True
+
+    if changed:
+        cache.achievements.invalidate(db)
+        db.commit()
+
+
+def new_stats(user_id):
+    return UserStats(user_id=user_id, labels=0, judged=0, agreed=0, streak=0, best_streak=0)
+
+
+def count(stats, day, agreed=None):
+    """
+    add one label to the stats. agreed is None for a label that was not judged
+    """
+    stats.labels += 1
+    if agreed is not None:
+        stats.judged += 1
+        stats.agreed += int(agreed)
+
+    if day is not None and day != stats.last_day:
+        if stats.last_day is not None and day - stats.last_day == timedelta(days=1):
+            stats.streak += 1
+        elif stats.last_day is None or day > stats.last_day:
+            stats.streak = 1
+        else:
+            # an older label during a rebuild, does not move the streak
+            return
+        stats.last_day = day
+        stats.best_streak = max(stats.best_streak, stats.streak)
+
+
+def majority(counts):
+    if counts:
+        return max(((int(k), v) for k, v in counts.items()), key=lambda x: (x[1], -x[0]))[0]
+
+
+def _award(db, stats, names, now):
+    """
+    insert the awards the users earned. stats {user_id: UserStats}. returns [(user, rule name)]
+    """
+    have = set(db.query(UserAchievement.user_id, UserAchievement.achievement_id).filter(
+        UserAchievement.user_id.in_(list(stats))))
+    ids = {name: row.id for name, row in cache.achievements.get(db, [r.name for r in RULES]).items()}
+
+    new = []
+    for user_id, st in stats.items():
+        for r in RULES:
+            aid = ids.get(r.name)
+            if aid is None or (user_id, aid) in have:
+                continue
+            if met(r, st, names.get(user_id)):
+                db.add(UserAchievement(user_id=user_id, achievement_id=aid, award_date=now))
+                new.append((names.get(user_id), r.name))
+    return new
+
+
+def record_labels(db, labels, now=None):
+    """
+    update the stats and awards for new labels, [(user_id, image_id, label_id)] in insert order.
+    call before the votes are added to the consensus, in the labeling transaction.
+    returns [(user, rule name)] awarded
+    """
+    now = now or datetime.utcnow()
+    day = now.date()
+
+    # rows are locked in key order, UserStats then Consensus, so two batches can't deadlock
+    user_ids = {u for u, _, _ in labels}
+    q = db.query(UserStats).filter(UserStats.user_id.in_(user_ids)).order_by(UserStats.user_id)
+    stats = {s.user_id: s for s in q.with_for_update()}
+    for u in user_ids:
+        if u not in stats:
+            stats[u] = new_stats(u)
+            db.add(stats[u])
+
+    # locked here rather than in add_votes, a concurrent label on the same image must wait until
+    # this one is counted or both are judged against the same votes
+    q = db.query(Consensus).filter(Consensus.image_id.in_({i for _, i, _ in labels}))
+    counts = {c.image_id: dict(c.counts or {}) for c in q.order_by(Consensus.image_id).with_for_update()}
+    for user_id, image_id, label_id in labels:
+        c = counts.setdefault(image_id, {})
+        m = majority(c)
+        count(stats[user_id], day, None if m is None else m == label_id)
+        k = str(label_id)
+        c[k] = c.get(k, 0) + 1
+
+    return _award(db, stats, cache.users.names(db, user_ids), now)
+
+
+def rebuild(db, batch=50000):
+    """
+    recompute every UserStats row and award from the label history. labels stored before they
+    had a create_date count towards everything but streaks
+    """
+    db.query(UserAchievement).delete(synchronize_session=False)
+    db.query(UserStats).delete(synchronize_session=False)
+
+    stats = {}
+    counts = {}
+    q = db.query(Labels.user_id, Labels.image_id, Labels.label_id, Labels.create_date)
+    q = q.filter(Labels.user_id != None, Labels.image_id != None, Labels.label_id != None)
+    for user_id, image_id, label_id, date in q.order_by(Labels.id).yield_per(batch):
+        st = stats.get(user_id)
+        if st is None:
+            st = stats[user_id] = new_stats(user_id)
+
+        c = counts.setdefault(image_id, {})
+        m = majority(c)
+        count(st, date.date() if date else None, None if m is None else m == label_id)
+        c[label_id] = c.get(label_id, 0) + 1
+
+    db.add_all(stats.values())
+    db.flush()
+    awarded = _award(db, stats, cache.users.names(db, list(stats)), datetime.utcnow())
+    db.commit()
+    return len(stats), len(awarded)
+
+
+def needs_rebuild(db):
+    """
+    labels exist but no stats, e.g. right after the migration
+    """
+    return (db.query(func.count(UserStats.id)).scalar() == 0 and
+            db.query(Labels.id).first() is not None)
+
+
+def scoreboard(db):
+    """
+    [{name, total, badges}] for every user with a label, from the precomputed tables
+    """
+    q = db.query(UserStats.user_id, UserStats.labels).filter(UserStats.labels > 0)
+    records = q.all()
+    names = cache.users.names(db, [u for u, _ in records])
+
+    badges = {}
+    q = db.query(UserAchievement.user_id, UserAchievement.achievement_id)
+    q = q.filter(UserAchievement.user_id.in_(list(names))).order_by(UserAchievement.achievement_id)
+    rows = cache.achievements.all(db)
+    by_id = {r.id: r.badge for r in rows}
+    for u, a in q:
+        badges.setdefault(u, []).append(by_id.get(a))
+
+    return [{'name': names[u], 'total': n, 'badges': badges.get(u, [])} for u, n in records]
+
+
+def user_achievements(db, user):
+    u = cache.users.get_one(db, user)
+    if u is None:
+        return
+
+    st = db.query(UserStats).filter(UserStats.user_id == u.id).first() or new_stats(u.id)
+    q = db.query(UserAchievement.achievement_id, UserAchievement.award_date)
+    awarded = dict(q.filter(UserAchievement.user_id == u.id))
+    rows = {r.name: r for r in cache.achievements.all(db)}
+    return {'name': user,
+            'labels': st.labels,
+            'judged': st.judged,
+            'agreed': st.agreed,
+            'streak': st.streak,
+            'best_streak': st.best_streak,
+            'achievements': [{'name': r.name,
+                              'badge': r.badge,
+                              'description': r.description,
+                              'awarded': awarded.get(rows[r.name].id) if r.name in rows else None}
+                             for r in RULES]}
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from api.session import get_db
+
+    parser = argparse.ArgumentParser(description='Achievement rules and awards')
+    parser.add_argument('--rebuild', action='store_true', help='recompute stats and awards from every label')
+    args = parser.parse_args()
+
+    sess = next(get_db())
+    sync_rules(sess)
+    if args.rebuild:
+        print('users, awards', rebuild(sess))
+    sess.close()
+# ============= EOF =============================================
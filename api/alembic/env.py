@@ -17,7 +17,11 @@ config = context.config
 
 # this will overwrite the ini-file sqlalchemy.url path
 # with the path given in the config of the main code
-config.set_main_option("sqlalchemy.url", os.environ["DATABASE_URL"])
+from api.config import settings
+config.set_main_option("sqlalchemy.url", settings.DATABASE_URL)
+
+# sqlite cannot ALTER most things in place, batch mode recreates the table instead
+render_as_batch = settings.DB_BACKEND == "sqlite"
 # This line sets up loggers basically.
 fileConfig(config.config_file_name)
 
@@ -48,6 +52,7 @@ def run_migrations_offline() -> None:
         target_metadata=target_metadata,
         literal_binds=True,
         dialect_opts={"paramstyle": "named"},
+        render_as_batch=render_as_batch,
     )
 
     with context.begin_transaction():
@@ -61,15 +66,20 @@ def run_migrations_online() -> None:
     and associate a connection with the context.
 
     """
-    connectable = engine_from_config(
-        config.get_section(config.config_ini_section),
-        prefix="sqlalchemy.",
-        poolclass=pool.NullPool,
-    )
+    if render_as_batch:
+        from api.session import make_engine
+        connectable = make_engine(settings.DATABASE_URL)
+    else:
+        connectable = engine_from_config(
+            config.get_section(config.config_ini_section),
+            prefix="sqlalchemy.",
+            poolclass=pool.NullPool,
+        )
 
     with connectable.connect() as connection:
         context.configure(
             connection=connection, target_metadata=target_metadata,
+            render_as_batch=render_as_batch,
         )
 
         with context.begin_transaction():
@@ -39,7 +39,7 @@ def upgrade() -> None:
     sa.Column('note', sa.String(), nullable=True),
     sa.Column('nxtals', sa.Integer(), nullable=True),
     sa.Column('weight', sa.Float(), nullable=True),
-    sa.Column('create_date', sa.DateTime(), server_default=sa.text('now()'), nullable=True),
+    sa.Column('create_date', sa.DateTime(), server_default=sa.func.now(), nullable=True),
     sa.PrimaryKeyConstraint('id')
     )
     op.create_index(op.f('ix_Image_id'), 'Image', ['id'], unique=False)
@@ -0,0 +1,28 @@
+"""image blob storage external
+
+Revision ID: b83e5f1a6c07
+Revises: 5e0c7a2d91f4
+Create Date: 2023-03-29 10:27:51.331902
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b83e5f1a6c07'
+down_revision = '5e0c7a2d91f4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # blobs are already compressed images. storing them out of line without pglz lets postgres
+    # read a substr() slice without detoasting the whole value. applies to rows written from now on
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute('ALTER TABLE "Image" ALTER COLUMN blob SET STORAGE EXTERNAL')
+
+
+def downgrade() -> None:
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute('ALTER TABLE "Image" ALTER COLUMN blob SET STORAGE EXTENDED')
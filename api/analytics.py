@@ -0,0 +1,368 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+"""
+columnar snapshot of the image metadata, labels and consensus for reporting.
+
+`python -m api.analytics` copies what changed since the last snapshot into parquet files under
+ANALYTICS_DIR, partitioned by loadname. images and labels are append only and copied by id
+watermark, consensus is rewritten whole every snapshot. /analytics/groupby answers from the files
+with arrow, it never queries the database.
+
+every file carries the snapshot version that wrote it and state.json is written last, readers
+only use files between a table's base version and the current one. a snapshot that dies half
+way leaves files nobody reads, they are removed by the next one.
+
+label rows whose transaction commits after a later id was already copied are missed until the
+next --full snapshot
+"""
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import func
+
+from api import cache
+from api.config import settings
+from api.models import Consensus, Image, Labels
+
+# image columns copied into every table so any of them can be grouped by
+DIMENSIONS = ('loadname', 'trayname', 'sample', 'material', 'project')
+INCREMENTAL = ('images', 'labels')
+TABLES = ('images', 'labels', 'consensus')
+AGGREGATES = ('sum', 'mean', 'min', 'max', 'count_distinct')
+
+PART_RE = re.compile(r'part-(\d+)-\d+\.parquet$')
+
+_datasets = {}
+_lock = threading.Lock()
+
+
+def _schemas():
+    import pyarrow as pa
+
+    dims = [(d, pa.string()) for d in DIMENSIONS]
+    return {'images': pa.schema([('id', pa.int64()),
+                                 ('hashid', pa.string()),
+                                 ('original_size', pa.int64()),
+                                 ('identifier', pa.string()),
+                                 ('hole_id', pa.int64()),
+                                 ('zoom_level', pa.float64()),
+                                 ('note', pa.string()),
+                                 ('nxtals', pa.int64()),
+                                 ('weight', pa.float64()),
+                                 ('create_date', pa.timestamp('us'))] + dims),
+            'labels': pa.schema([('id', pa.int64()),
+                                 ('image_id', pa.int64()),
+                                 ('label', pa.string()),
+                                 ('user', pa.string()),
+                                 ('hole_id', pa.int64())] + dims),
+            'consensus': pa.schema([('image_id', pa.int64()),
+                                    ('label', pa.string()),
+                                    ('votes', pa.int64()),
+                                    ('agreement', pa.float64()),
+                                    ('hole_id', pa.int64())] + dims)}
+
+
+def _partitioning():
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    return ds.partitioning(pa.schema([('loadname', pa.string())]), flavor='hive')
+
+
+# ------------------------------------------------------------------------------------- state
+def state_path():
+    return os.path.join(settings.ANALYTICS_DIR, 'state.json')
+
+
+def load_state():
+    try:
+        with open(state_path(), 'r') as rfile:
+            return json.load(rfile)
+    except FileNotFoundError:
+        return
+
+
+def _save_state(state):
+    path = state_path()
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as wfile:
+        json.dump(state, wfile, indent=1)
+    os.replace(tmp, path)
+
+
+def _parts(table):
+    """
+    (version, path) of every parquet file of a table
+    """
+    root = os.path.join(settings.ANALYTICS_DIR, table)
+    for d, _, names in os.walk(root):
+        for n in names:
+            m = PART_RE.match(n)
+            if m:
+                yield int(m.group(1)), os.path.join(d, n)
+
+
+def files(state, table):
+    base, version = state['base'][table], state['version']
+    return sorted(p for v, p in _parts(table) if base <= v <= version)
+
+
+# ------------------------------------------------------------------------------------- snapshot
+def _image_rows(db, lo, hi):
+    cols = ('id', 'hashid', 'original_size', 'identifier', 'hole_id', 'zoom_level', 'note', 'nxtals',
+            'weight', 'create_date') + DIMENSIONS
+    q = db.query(*(getattr(Image, c) for c in cols)).filter(Image.id > lo, Image.id <= hi)
+    for r in q.order_by(Image.id).yield_per(settings.ANALYTICS_BATCH):
+        yield r._asdict()
+
+
+def _named(db, rows):
+    labels = cache.labels.names(db, {r['label_id'] for r in rows if r['label_id'] is not None})
+    users = cache.users.names(db, {r.get('user_id') for r in rows if r.get('user_id') is not None})
+    for r in rows:
+        r['label'] = labels.get(r.pop('label_id'))
+        if 'user_id' in r:
+            r['user'] = users.get(r.pop('user_id'))
+    return rows
+
+
+def _label_rows(db, lo, hi):
+    q = db.query(Labels.id, Labels.image_id, Labels.label_id, Labels.user_id, Image.hole_id,
+                 *(getattr(Image, d) for d in DIMENSIONS))
+    q = q.join(Image, Labels.image_id == Image.id).filter(Labels.id > lo, Labels.id <= hi)
+    for r in q.order_by(Labels.id).yield_per(settings.ANALYTICS_BATCH):
+        yield r._asdict()
+
+
+def _consensus_rows(db):
+    q = db.query(Consensus.image_id, Consensus.label_id, Consensus.votes, Consensus.agreement,
+                 Image.hole_id, *(getattr(Image, d) for d in DIMENSIONS))
+    q = q.join(Image, Consensus.image_id == Image.id)
+    for r in q.order_by(Consensus.image_id).yield_per(settings.ANALYTICS_BATCH):
+        yield r._asdict()
+
+
+def _batches(db, rows, schema, named=False):
+    """
+    record batches of ANALYTICS_BATCH rows, only one batch of rows is held at a time
+    """
+    import pyarrow as pa
+
+    buf = []
+    for r in rows:
+        buf.append(r)
+        if len(buf) == settings.ANALYTICS_BATCH:
+            yield pa.RecordBatch.from_pylist(_named(db, buf) if named else buf, schema=schema)
+            buf = []
+    if buf:
+        yield pa.RecordBatch.from_pylist(_named(db, buf) if named else buf, schema=schema)
+
+
+def _write(table, version, batches, schema):
+    """
+    write into a staging directory then move the files in place. returns the number of rows
+    """
+    import pyarrow.dataset as ds
+
+    staging = os.path.join(settings.ANALYTICS_DIR, f'.staging-{table}-{version}')
+    shutil.rmtree(staging, ignore_errors=True)
+
+    n = 0
+
+    def counted():
+        nonlocal n
+        for b in batches:
+            n += b.num_rows
+            yield b
+
+    ds.write_dataset(counted(), staging, schema=schema, format='parquet', partitioning=_partitioning(),
+                     basename_template=f'part-{version}-{{i}}.parquet',
+                     existing_data_behavior='overwrite_or_ignore')
+
+    root = os.path.join(settings.ANALYTICS_DIR, table)
+    for d, _, names in os.walk(staging):
+        dest = os.path.join(root, os.path.relpath(d, staging))
+        os.makedirs(dest, exist_ok=True)
+        for name in names:
+            os.replace(os.path.join(d, name), os.path.join(dest, name))
+    shutil.rmtree(staging, ignore_errors=True)
+    return n
+
+
+def _remove(table, keep):
+    """
+    delete the files of a table outside the versions in keep
+    """
+    lo, hi = keep
+    for v, p in list(_parts(table)):
+        if not lo <= v <= hi:
+            os.remove(p)
+
+
+def snapshot(db, full=False):
+    """
+    copy what changed since the last snapshot. full starts every table over, e.g. to pick up
+    label rows a concurrent transaction committed late. returns the new state
+    """
+    os.makedirs(settings.ANALYTICS_DIR, exist_ok=True)
+    prev = load_state() or {'version': 0,
+                            'base': {t: 1 for t in TABLES},
+                            'watermarks': {t: 0 for t in INCREMENTAL},
+                            'rows': {t: 0 for t in TABLES}}
+
+    # left behind by a snapshot that died before saving its state
+    for t in TABLES:
+        _remove(t, (0, prev['version']))
+
+    version = prev['version'] + 1
+    state = {'version': version,
+             'base': dict(prev['base']),
+             'watermarks': dict(prev['watermarks']),
+             'rows': dict(prev['rows'])}
+    if full:
+        for t in INCREMENTAL:
+            state['base'][t] = version
+            state['watermarks'][t] = 0
+            state['rows'][t] = 0
+
+    schemas = _schemas()
+    st = time.time()
+    for t, model, rows in (('images', Image, _image_rows), ('labels', Labels, _label_rows)):
+        lo = state['watermarks'][t]
+        hi = db.query(func.max(model.id)).scalar() or 0
+        if hi > lo:
+            named = t == 'labels'
+            n = _write(t, version, _batches(db, rows(db, lo, hi), schemas[t], named), schemas[t])
+            state['rows'][t] += n
+        state['watermarks'][t] = max(hi, lo)
+
+    n = _write('consensus', version, _batches(db, _consensus_rows(db), schemas['consensus'], True),
+               schemas['consensus'])
+    state['rows']['consensus'] = n
+    state['base']['consensus'] = version
+    db.rollback()
+
+    state['as_of'] = datetime.utcnow().isoformat()
+    state['duration'] = round(time.time() - st, 3)
+    _save_state(state)
+
+    # the previous consensus, or everything before a full snapshot, is no longer read
+    for t in TABLES:
+        _remove(t, (state['base'][t], version))
+    return state
+
+
+# ------------------------------------------------------------------------------------- queries
+def dataset(table):
+    """
+    the current snapshot of a table as an arrow dataset, reopened when a new snapshot is saved
+    """
+    import pyarrow.dataset as ds
+
+    state = load_state()
+    if state is None:
+        return None, None
+
+    key = (table, state['version'])
+    with _lock:
+        hit = _datasets.get(key)
+    if hit is None:
+        root = os.path.join(settings.ANALYTICS_DIR, table)
+        hit = ds.dataset(files(state, table), schema=_schemas()[table], format='parquet',
+                         partitioning=_partitioning(), partition_base_dir=root)
+        with _lock:
+            for k in [k for k in _datasets if k[0] == table]:
+                _datasets.pop(k)
+            _datasets[key] = hit
+    return state, hit
+
+
+def groupby(table, by=(), filters=None, aggs=(), limit=None):
+    """
+    row count per group, plus `column:op` aggregates. filters are {column: value} equality tests
+    """
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+
+    if table not in TABLES:
+        raise ValueError(f'unknown table {table}, use one of {", ".join(TABLES)}')
+
+    schema = _schemas()[table]
+    columns = set(schema.names)
+    by = [b for b in by if b]
+    filters = filters or {}
+    for c in list(by) + list(filters):
+        if c not in columns:
+            raise ValueError(f'{table} has no column {c}')
+
+    aggregates = []
+    for a in aggs:
+        col, _, op = a.partition(':')
+        if col not in columns or op not in AGGREGATES:
+            raise ValueError(f'invalid aggregate {a}, use column:op with op one of {", ".join(AGGREGATES)}')
+        aggregates.append((col, op))
+
+    state, dset = dataset(table)
+    if state is None:
+        return
+
+    expr = None
+    for c, v in filters.items():
+        f = pc.field(c) == ds.scalar(v).cast(schema.field(c).type)
+        expr = f if expr is None else expr & f
+
+    needed = sorted(set(by) | {c for c, _ in aggregates})
+    t = dset.to_table(columns=needed, filter=expr)
+    g = t.group_by(by).aggregate([([], 'count_all')] + aggregates)
+    g = g.rename_columns(['count' if n == 'count_all' else n for n in g.column_names])
+    g = g.sort_by([('count', 'descending')] + [(b, 'ascending') for b in by])
+    if limit:
+        g = g.slice(0, limit)
+
+    return {'snapshot': {'version': state['version'], 'as_of': state['as_of']},
+            'rows': t.num_rows,
+            'table': g.to_pylist()}
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from api.session import get_db
+
+    parser = argparse.ArgumentParser(description='Write the analytics snapshot')
+    parser.add_argument('--full', action='store_true', help='rewrite every table instead of appending')
+    parser.add_argument('--every', type=float, nargs='?', const=settings.ANALYTICS_INTERVAL, metavar='SECONDS',
+                        help='keep taking snapshots, every ANALYTICS_INTERVAL seconds by default')
+    args = parser.parse_args()
+
+    full = args.full
+    while 1:
+        sess = next(get_db())
+        try:
+            s = snapshot(sess, full)
+        finally:
+            sess.close()
+        print(f"snapshot {s['version']} {s['duration']}s rows {s['rows']}")
+        if not args.every:
+            break
+        full = False
+        time.sleep(args.every)
+# ============= EOF =============================================
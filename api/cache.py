@@ -0,0 +1,176 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import threading
+import time
+from collections import OrderedDict
+
+from api.config import settings
+from api.models import Achievement, CacheVersion, Label, User
+
+
+def version(db, name):
+    """
+    the shared version of `name`, 0 if it was never bumped
+    """
+    return db.query(CacheVersion.version).filter(CacheVersion.name == name).scalar() or 0
+
+
+def bump(db, name):
+    """
+    bump the shared version of `name` so every process drops what it cached. the caller commits
+    """
+    n = db.query(CacheVersion).filter(CacheVersion.name == name).update(
+        {CacheVersion.version: CacheVersion.version + 1}, synchronize_session=False)
+    if not n:
+        db.add(CacheVersion(name=name, version=1))
+
+
+class LookupCache:
+    """
+    in-process cache of a small reference table keyed by name, e.g. Label or User.
+
+    entries are LRU bounded and expire after ttl seconds. every check_interval seconds the cache
+    compares its version with the CacheVersion row of the table and drops everything if another
+    process bumped it, so workers see new rows without each lookup hitting the database.
+    call invalidate(db) in the transaction that creates or changes a row
+    """
+
+    def __init__(self, model, columns=('id',), maxsize=None, ttl=None, check_interval=None):
+        self.model = model
+        self.name = model.__tablename__
+        self.columns = columns
+        self.maxsize = maxsize or settings.LOOKUP_CACHE_SIZE
+        self.ttl = ttl if ttl is not None else settings.LOOKUP_CACHE_TTL
+        self.check_interval = check_interval if check_interval is not None else settings.LOOKUP_CACHE_CHECK
+
+        self._lock = threading.Lock()
+        self._by_name = OrderedDict()
+        self._by_id = OrderedDict()
+        self._all = None
+        self._version = None
+        self._checked = 0
+
+    def clear(self):
+        with self._lock:
+            self._by_name.clear()
+            self._by_id.clear()
+            self._all = None
+
+    def invalidate(self, db):
+        """
+        bump the shared version. the caller commits
+        """
+        self.clear()
+        bump(db, self.name)
+
+    def _check(self, db):
+        now = time.monotonic()
+        if now - self._checked < self.check_interval:
+            return
+        self._checked = now
+
+        v = db.query(CacheVersion.version).filter(CacheVersion.name == self.name).scalar()
+        if v != self._version:
+            self.clear()
+            self._version = v
+
+    def _put(self, name, row, expires):
+        self._by_name[name] = (row, expires)
+        self._by_name.move_to_end(name)
+        self._by_id[row.id] = (name, expires)
+        self._by_id.move_to_end(row.id)
+        while len(self._by_name) > self.maxsize:
+            self._by_name.popitem(last=False)
+        while len(self._by_id) > self.maxsize:
+            self._by_id.popitem(last=False)
+
+    def _query(self, db):
+        return db.query(self.model.name, *(getattr(self.model, c) for c in self.columns))
+
+    def get(self, db, names):
+        """
+        returns {name: row} for the names that exist, row has the cached columns as attributes
+        """
+        self._check(db)
+        now = time.monotonic()
+        found, missing = {}, []
+        with self._lock:
+            for name in names:
+                hit = self._by_name.get(name)
+                if hit and hit[1] > now:
+                    found[name] = hit[0]
+                    self._by_name.move_to_end(name)
+                else:
+                    missing.append(name)
+
+        if missing:
+            rows = self._query(db).filter(self.model.name.in_(missing)).all()
+            with self._lock:
+                for row in rows:
+                    self._put(row.name, row, now + self.ttl)
+                    found[row.name] = row
+        return found
+
+    def get_one(self, db, name):
+        return self.get(db, [name]).get(name)
+
+    def names(self, db, ids):
+        """
+        returns {id: name}
+        """
+        self._check(db)
+        now = time.monotonic()
+        found, missing = {}, []
+        with self._lock:
+            for i in ids:
+                hit = self._by_id.get(i)
+                if hit and hit[1] > now:
+                    found[i] = hit[0]
+                    self._by_id.move_to_end(i)
+                else:
+                    missing.append(i)
+
+        if missing:
+            rows = self._query(db).filter(self.model.id.in_(missing)).all()
+            with self._lock:
+                for row in rows:
+                    self._put(row.name, row, now + self.ttl)
+                    found[row.id] = row.name
+        return found
+
+    def all(self, db):
+        """
+        every row ordered by id
+        """
+        self._check(db)
+        now = time.monotonic()
+        with self._lock:
+            if self._all and self._all[1] > now:
+                return self._all[0]
+
+        rows = self._query(db).order_by(self.model.id).all()
+        with self._lock:
+            self._all = (rows, now + self.ttl)
+            for row in rows[:self.maxsize]:
+                self._put(row.name, row, now + self.ttl)
+        return rows
+
+
+labels = LookupCache(Label)
+users = LookupCache(User, columns=('id', 'reliability'))
+achievements = LookupCache(Achievement, columns=('id', 'badge', 'description'))
+
+# ============= EOF =============================================
@@ -0,0 +1,199 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+"""
+change feed of inserted images and labels.
+
+the write paths add a Change row per inserted row right before they commit. Change.id is the
+cursor, so it has to grow in commit order or a reader could pass a change that commits later
+with a smaller id. on postgres record() takes a transaction level advisory lock, the next writer
+waits for it before allocating an id. sqlite has a single writer anyway
+"""
+import asyncio
+from datetime import datetime
+
+from sqlalchemy import func, text
+from starlette.concurrency import run_in_threadpool
+
+from api import cache
+from api.config import settings
+from api.export import METADATA
+from api.models import Change, Image, Labels
+from api.session import SessionLocal, get_engine
+
+KINDS = ('image', 'label')
+
+# pg_advisory_xact_lock key, any constant no other code uses
+LOCK_KEY = 0x7472_6179
+
+
+def record(db, kind, ids):
+    """
+    add the changes for rows inserted in this transaction, the caller commits right after
+    """
+    if not ids:
+        return
+
+    if db.bind.dialect.name == 'postgresql':
+        db.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': LOCK_KEY})
+
+    now = datetime.utcnow()
+    db.bulk_insert_mappings(Change, [{'kind': kind, 'ref_id': i, 'create_date': now} for i in ids])
+
+
+def latest(db):
+    return db.query(func.max(Change.id)).scalar() or 0
+
+
+def _image_rows(db, ids):
+    q = db.query(*(getattr(Image, c) for c in METADATA)).filter(Image.id.in_(ids))
+    return {r.id: r._asdict() for r in q}
+
+
+def _label_rows(db, ids):
+    q = db.query(Labels.id, Labels.image_id, Image.hashid, Labels.label_id, Labels.user_id,
+                 Labels.client_event_id, Labels.create_date)
+    q = q.outerjoin(Image, Image.id == Labels.image_id).filter(Labels.id.in_(ids))
+    rows = [r._asdict() for r in q]
+
+    labels = cache.labels.names(db, {r['label_id'] for r in rows if r['label_id'] is not None})
+    users = cache.users.names(db, {r['user_id'] for r in rows if r['user_id'] is not None})
+    for r in rows:
+        r['label'] = labels.get(r.pop('label_id'))
+        r['user'] = users.get(r.pop('user_id'))
+    return {r['id']: r for r in rows}
+
+
+def read(db, since=0, limit=None, kinds=None):
+    """
+    up to limit changes after the cursor `since`, oldest first, each with the row it refers to.
+    one query for the changes and one per kind for the rows
+    """
+    limit = min(limit or settings.CHANGES_LIMIT, settings.CHANGES_MAX_LIMIT)
+    # everything up to top is committed, so the cursor can move there even if the kinds filter
+    # left nothing to return
+    top = latest(db)
+    q = db.query(Change.id, Change.kind, Change.ref_id, Change.create_date)
+    q = q.filter(Change.id > since, Change.id <= top)
+    if kinds:
+        q = q.filter(Change.kind.in_(kinds))
+    changes = q.order_by(Change.id).limit(limit).all()
+
+    rows = {}
+    for kind, load in (('image', _image_rows), ('label', _label_rows)):
+        ids = [c.ref_id for c in changes if c.kind == kind]
+        rows[kind] = load(db, ids) if ids else {}
+
+    out = [{'cursor': c.id,
+            'kind': c.kind,
+            'op': 'insert',
+            'create_date': c.create_date,
+            'data': rows[c.kind].get(c.ref_id)} for c in changes]
+
+    more = len(changes) == limit
+    return {'cursor': changes[-1].id if more else max(since, top),
+            'more': more,
+            'changes': out}
+
+
+def _with_session(func, *args, **kw):
+    # a short lived session, a long poll must not hold a pooled connection while it waits
+    db = SessionLocal(bind=get_engine())
+    try:
+        return func(db, *args, **kw)
+    finally:
+        db.close()
+
+
+class Watcher:
+    """
+    wakes up long polls once the feed moves past their cursor. while anyone waits a single task
+    polls the latest cursor every CHANGES_POLL seconds, however many requests are waiting
+    """
+
+    def __init__(self, interval=None):
+        self.interval = interval or settings.CHANGES_POLL
+        self.latest = None
+        self._cond = None
+        self._loop = None
+        self._task = None
+        self._waiting = 0
+
+    def _condition(self):
+        # bound to the loop that first waits, made again if the app is served by a new loop
+        loop = asyncio.get_event_loop()
+        if self._cond is None or self._loop is not loop:
+            self._cond = asyncio.Condition()
+            self._loop = loop
+            self._task = None
+            self._waiting = 0
+        return self._cond
+
+    async def wait(self, since, timeout):
+        """
+        True once there is a change after since, False after timeout seconds
+        """
+        cond = self._condition()
+        self._waiting += 1
+        if self._task is None:
+            self._task = self._loop.create_task(self._run())
+        try:
+            async with cond:
+                await asyncio.wait_for(cond.wait_for(lambda: (self.latest or 0) > since), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._waiting -= 1
+
+    async def _run(self):
+        cond = self._cond
+        try:
+            while self._waiting:
+                try:
+                    v = await run_in_threadpool(_with_session, latest)
+                except Exception as e:
+                    print('change watcher poll failed', e)
+                else:
+                    async with cond:
+                        self.latest = v
+                        cond.notify_all()
+                await asyncio.sleep(self.interval)
+        finally:
+            if self._cond is cond:
+                self._task = None
+
+
+watcher = Watcher()
+
+
+async def poll(since=0, limit=None, kinds=None, wait=0):
+    """
+    read(), waiting up to `wait` seconds for a change if there is none yet
+    """
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + min(max(wait, 0), settings.CHANGES_MAX_WAIT)
+    while 1:
+        obj = await run_in_threadpool(_with_session, read, since, limit, kinds)
+        remaining = deadline - loop.time()
+        if obj['changes'] or remaining <= 0:
+            return obj
+
+        # a change of another kind moves the cursor without returning anything, keep waiting
+        since = obj['cursor']
+        if not await watcher.wait(since, remaining):
+            return obj
+
+# ============= EOF =============================================
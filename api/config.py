@@ -34,7 +34,71 @@ class Settings:
         "POSTGRES_PORT", 5432
     )  # default postgres port is 5432
     POSTGRES_DB: str = os.getenv("POSTGRES_DB", "tdd")
-    DATABASE_URL = f"postgresql+psycopg2://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
+
+    # postgres or sqlite. sqlite is the embedded single node mode, no database server needed
+    DB_BACKEND: str = os.getenv(
+        "DB_BACKEND",
+        "sqlite" if os.getenv("DATABASE_URL", "").startswith("sqlite") else "postgres",
+    )
+    SQLITE_PATH: str = os.getenv("SQLITE_PATH", "./data/trayclassifier.db")
+    DATABASE_URL = os.getenv("DATABASE_URL") or (
+        f"sqlite:///{SQLITE_PATH}"
+        if DB_BACKEND == "sqlite"
+        else f"postgresql+psycopg2://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
+    )
+
+    # where new image bytes go. db stores them in Image.blob, disk in BLOB_DIR
+    BLOB_STORE: str = os.getenv("BLOB_STORE", "disk" if DB_BACKEND == "sqlite" else "db")
+    BLOB_DIR: str = os.getenv("BLOB_DIR", "./data/blobs")
+
+    FEATURE_PATH: str = os.getenv("FEATURE_PATH", "./data/features.f32")
+    STORAGE_CODEC: str = os.getenv("STORAGE_CODEC", "tiff_deflate")
+
+    CROP_MARGIN: int = int(os.getenv("CROP_MARGIN", 100))
+    TRAY_TEMPLATE_DIR: str = os.getenv(
+        "TRAY_TEMPLATE_DIR", os.path.join(os.path.dirname(__file__), "trays")
+    )
+
+    EVENT_DEBOUNCE: float = float(os.getenv("EVENT_DEBOUNCE", 1.0))
+
+    IMAGE_CHUNK_SIZE: int = int(os.getenv("IMAGE_CHUNK_SIZE", 256 * 1024))
+    IMAGE_INFLIGHT_BYTES: int = int(os.getenv("IMAGE_INFLIGHT_BYTES", 64 * 1024 * 1024))
+
+    THUMBNAIL_SIZE: int = int(os.getenv("THUMBNAIL_SIZE", 64))
+    MOSAIC_CACHE_SIZE: int = int(os.getenv("MOSAIC_CACHE_SIZE", 32))
+
+    # deep zoom tile pyramids, png or jpeg tiles
+    TILE_DIR: str = os.getenv("TILE_DIR", "./data/tiles")
+    TILE_SIZE: int = int(os.getenv("TILE_SIZE", 256))
+    TILE_OVERLAP: int = int(os.getenv("TILE_OVERLAP", 1))
+    TILE_FORMAT: str = os.getenv("TILE_FORMAT", "png")
+    TILE_QUALITY: int = int(os.getenv("TILE_QUALITY", 90))
+    # decoded images kept in memory while their tiles are rendered
+    TILE_SOURCE_CACHE: int = int(os.getenv("TILE_SOURCE_CACHE", 4))
+
+    # accept uploads with 202 and leave thumbnails, features and encoding to `python -m api.worker`
+    INGEST_ASYNC: bool = bool(int(os.getenv("INGEST_ASYNC", 0)))
+    INGEST_WORKERS: int = int(os.getenv("INGEST_WORKERS", os.cpu_count() or 1))
+    INGEST_MAX_ATTEMPTS: int = int(os.getenv("INGEST_MAX_ATTEMPTS", 5))
+    INGEST_BACKOFF: float = float(os.getenv("INGEST_BACKOFF", 2.0))
+    INGEST_POLL: float = float(os.getenv("INGEST_POLL", 1.0))
+    INGEST_JOB_TIMEOUT: float = float(os.getenv("INGEST_JOB_TIMEOUT", 600))
+    MAX_PENDING_JOBS: int = int(os.getenv("MAX_PENDING_JOBS", 10000))
+
+    # parquet snapshot for /analytics, written by `python -m api.analytics`
+    ANALYTICS_DIR: str = os.getenv("ANALYTICS_DIR", "./data/analytics")
+    ANALYTICS_BATCH: int = int(os.getenv("ANALYTICS_BATCH", 50000))
+    ANALYTICS_INTERVAL: float = float(os.getenv("ANALYTICS_INTERVAL", 300))
+
+    # /changes page size and long poll
+    CHANGES_LIMIT: int = int(os.getenv("CHANGES_LIMIT", 500))
+    CHANGES_MAX_LIMIT: int = int(os.getenv("CHANGES_MAX_LIMIT", 5000))
+    CHANGES_MAX_WAIT: float = float(os.getenv("CHANGES_MAX_WAIT", 30))
+    CHANGES_POLL: float = float(os.getenv("CHANGES_POLL", 0.5))
+
+    LOOKUP_CACHE_SIZE: int = int(os.getenv("LOOKUP_CACHE_SIZE", 4096))
+    LOOKUP_CACHE_TTL: float = float(os.getenv("LOOKUP_CACHE_TTL", 300))
+    LOOKUP_CACHE_CHECK: float = float(os.getenv("LOOKUP_CACHE_CHECK", 2))
 
 
 settings = Settings()
@@ -0,0 +1,176 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+from sqlalchemy import func
+
+from api import cache
+from api.models import Consensus, Labels, User
+
+
+def _resolve(c, counts, weights):
+    """
+    majority is the label with the largest weight, ties go to the lowest label id
+    """
+    label_id, w = max(((int(k), v) for k, v in weights.items()), key=lambda x: (x[1], -x[0]))
+    total = sum(weights.values())
+
+    c.counts = counts
+    c.weights = weights
+    c.votes = sum(counts.values())
+    c.label_id = label_id
+    c.agreement = w / total if total else 0
+
+
+def add_vote(db, image_id, label_id, weight=None):
+    """
+    update the consensus of one image for a new label. called in the same transaction as the
+    Labels insert, the caller commits
+    """
+    return add_votes(db, [(image_id, label_id, weight)])[image_id]
+
+
+def add_votes(db, votes):
+    """
+    votes: sequence of (image_id, label_id, weight). all affected Consensus rows are read (and
+    locked) with one query. returns {image_id: Consensus}
+    """
+    image_ids = {iid for iid, _, _ in votes}
+    q = db.query(Consensus).filter(Consensus.image_id.in_(image_ids))
+    q = q.order_by(Consensus.image_id).with_for_update()
+    rows = {c.image_id: c for c in q}
+
+    for image_id, label_id, weight in votes:
+        if weight is None:
+            weight = 1.0
+
+        c = rows.get(image_id)
+        if c is None:
+            c = Consensus(image_id=image_id)
+            db.add(c)
+            rows[image_id] = c
+
+        # copy so the JSON columns are flagged as modified
+        counts = dict(c.counts or {})
+        weights = dict(c.weights or {})
+        k = str(label_id)
+        counts[k] = counts.get(k, 0) + 1
+        weights[k] = weights.get(k, 0) + weight
+        _resolve(c, counts, weights)
+    return rows
+
+
+def estimate_reliability(ii, li, ui, counts, nusers, iterations=5):
+    """
+    labeler weight = smoothed fraction of a user's labels that agree with the weighted majority,
+    only counting images with more than one vote. iterated a few times so reliable labelers
+    pull the majority towards them
+    """
+    import numpy as np
+
+    n, m = counts.shape
+    multi = (counts.sum(axis=1) > 1)[ii]
+    judged = np.bincount(ui, weights=multi, minlength=nusers)
+
+    w = np.ones(nusers)
+    for _ in range(iterations):
+        weights = np.bincount(ii * m + li, weights=w[ui], minlength=n * m).reshape(n, m)
+        agree = (weights.argmax(axis=1)[ii] == li) & multi
+        hits = np.bincount(ui, weights=agree, minlength=nusers)
+        w = (hits + 1) / (judged + 2)
+    return w
+
+
+def recompute(db, weighted=False, iterations=5):
+    """
+    rebuild Consensus from the full label matrix. returns the number of images with a consensus
+    """
+    import numpy as np
+
+    q = db.query(Labels.image_id, Labels.label_id, Labels.user_id)
+    q = q.filter(Labels.image_id != None, Labels.label_id != None, Labels.user_id != None)
+    rows = np.array(q.all(), dtype=np.int64).reshape(-1, 3)
+
+    db.query(Consensus).delete(synchronize_session=False)
+    # the incremental path keeps Image/Labels versions moving, a recompute has to say so itself
+    cache.bump(db, Consensus.__tablename__)
+    if not len(rows):
+        db.commit()
+        return 0
+
+    images, ii = np.unique(rows[:, 0], return_inverse=True)
+    labels, li = np.unique(rows[:, 1], return_inverse=True)
+    users, ui = np.unique(rows[:, 2], return_inverse=True)
+    n, m = len(images), len(labels)
+
+    counts = np.bincount(ii * m + li, minlength=n * m).reshape(n, m)
+    if weighted:
+        w = estimate_reliability(ii, li, ui, counts, len(users), iterations)
+        db.bulk_update_mappings(User, [{'id': int(u), 'reliability': float(r)} for u, r in zip(users, w)])
+        cache.users.invalidate(db)
+    else:
+        reliability = dict(db.query(User.id, User.reliability))
+        w = np.array([reliability.get(int(u)) or 1.0 for u in users])
+
+    weights = np.bincount(ii * m + li, weights=w[ui], minlength=n * m).reshape(n, m)
+    majority = weights.argmax(axis=1)
+    totals = weights.sum(axis=1)
+    agreement = np.divide(weights[np.arange(n), majority], totals, out=np.zeros(n), where=totals > 0)
+    votes = counts.sum(axis=1)
+
+    mappings = []
+    for i in range(n):
+        nz = np.flatnonzero(counts[i])
+        mappings.append({'image_id': int(images[i]),
+                         'label_id': int(labels[majority[i]]),
+                         'votes': int(votes[i]),
+                         'agreement': float(agreement[i]),
+                         'counts': {str(labels[j]): int(counts[i, j]) for j in nz},
+                         'weights': {str(labels[j]): float(weights[i, j]) for j in nz}})
+    db.bulk_insert_mappings(Consensus, mappings)
+    db.commit()
+    return n
+
+
+def consensus_report(db):
+    records = db.query(Consensus.label_id, func.count(Consensus.id)).group_by(Consensus.label_id).all()
+    names = cache.labels.names(db, [l for l, c in records])
+    return [{'label': names[l], 'count': c} for l, c in records]
+
+
+def classified_count(db):
+    return db.query(func.count(Consensus.id)).scalar()
+
+
+def to_dict(c, names):
+    return {'image_id': c.image_id,
+            'label': names.get(c.label_id),
+            'votes': c.votes,
+            'agreement': c.agreement,
+            'counts': {names.get(int(k)): v for k, v in (c.counts or {}).items()},
+            'weights': {names.get(int(k)): v for k, v in (c.weights or {}).items()}}
+
+
+if __name__ == '__main__':
+    import argparse
+    from api.session import get_db
+
+    parser = argparse.ArgumentParser(description='Rebuild the label consensus')
+    parser.add_argument('--weighted', action='store_true', help='estimate labeler reliability weights')
+    args = parser.parse_args()
+
+    sess = next(get_db())
+    print('images with consensus', recompute(sess, args.weighted))
+    sess.close()
+# ============= EOF =============================================
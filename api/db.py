@@ -17,12 +17,13 @@ import hashlib
 import io
 import os
 
-from api.models import Base, Label, Image, Labels, User
-from api.session import get_db, engine
+from api import achievements, cache, changes, labeling
+from api.config import settings
+from api.consensus import recompute
+from api.models import Base, Label, Image, Labels, User, Consensus
+from api.session import get_db
+from api.storage import new_image
 from sqlalchemy.exc import NoResultFound
-from PIL import Image as PILImage, UnidentifiedImageError
-from skimage.color.colorconv import rgb2gray
-from numpy import array
 
 
 def add_label(s, l):
@@ -34,6 +35,7 @@ def add_label(s, l):
     except NoResultFound:
         ll = Label(name=l)
         s.add(ll)
+        cache.labels.invalidate(s)
         s.commit()
 
 
@@ -43,18 +45,27 @@ def add_default_user(s):
     except NoResultFound:
         u = User(name='default')
         s.add(u)
+        cache.users.invalidate(s)
         s.commit()
 
 
 def setup_db():
+    """
+    seed the reference data and optionally the example images. safe to run repeatedly, it is
+    run once per deploy with `python -m api.db` after the migrations
+    """
     # Base.metadata.create_all(bind=engine)
 
     sess = next(get_db())
     add_default_user(sess)
     for l in ('good', 'bad', 'empty', 'multigrain', 'contaminant', 'blurry'):
         add_label(sess, l)
+    achievements.sync_rules(sess)
 
     if int(os.environ.get('LOAD_PICS', 0)):
+        from PIL import Image as PILImage, UnidentifiedImageError
+        from api.features import update_features
+
         for tag in ('blurry', 'empty'):
             root = f'./data/421{tag}'
             for f in os.listdir(root):
@@ -62,9 +73,9 @@ def setup_db():
                 try:
                     img = PILImage.open(p)
                     width, height = img.size
-                    left = 100
+                    left = settings.CROP_MARGIN
                     right = width - left
-                    bottom = 100
+                    bottom = settings.CROP_MARGIN
                     top = height - bottom
                     img = img.crop((left, bottom, right, top))
                 except UnidentifiedImageError as e:
@@ -89,20 +100,34 @@ def setup_db():
                     pass
                 name = os.path.basename(p)
                 hole_id = name.split('.')[0]
-                dbim = Image(blob=buf,
-                             sample='foo',
-                             material='sanidine',
-                             identifier=1000,
-                             trayname='421-hole',
-                             loadname='test148',
-                             hole_id=int(hole_id), hashid=ha)
+                dbim = new_image(buf,
+                                 sample='foo',
+                                 material='sanidine',
+                                 identifier=1000,
+                                 trayname='421-hole',
+                                 loadname='test148',
+                                 hole_id=int(hole_id), hashid=ha)
                 # print('asdfasdfasd', name, dbim)
                 sess.add(dbim)
+                sess.flush()
+                changes.record(sess, 'image', [dbim.id])
                 if tag == 'blurry':
-                    l = Labels(image=dbim, label_id=6, user_id=1)
-                    sess.add(l)
+                    # the same path as a labeler, so the stats and awards stay in step
+                    labeling.apply_labels(sess, [{'image_id': dbim.id, 'label': tag, 'user': 'default'}])
                 sess.commit()
                 # d.add_labeled_sample(p, array(img), tag)
 
+        update_features(sess)
+
+    if sess.query(Labels.id).first() and not sess.query(Consensus.id).first():
+        recompute(sess)
+
+    if achievements.needs_rebuild(sess):
+        achievements.rebuild(sess)
+
     sess.close()
+
+
+if __name__ == '__main__':
+    setup_db()
 # ============= EOF =============================================
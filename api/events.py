@@ -0,0 +1,163 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import asyncio
+
+import orjson
+from starlette.concurrency import run_in_threadpool
+
+from api import reports
+from api.config import settings
+from api.session import get_db
+
+KEEPALIVE = 15
+
+
+def snapshot():
+    db = next(get_db())
+    try:
+        return {'counts': reports.results_report(db),
+                'scoreboard': {r['name']: r for r in reports.scoreboard_rows(db)}}
+    finally:
+        db.close()
+
+
+def version():
+    db = next(get_db())
+    try:
+        return reports.version(db)
+    finally:
+        db.close()
+
+
+def diff(old, new):
+    """
+    counts are sent whole when they change, scoreboard only the rows that changed
+    """
+    delta = {}
+    if old is None or old['counts'] != new['counts']:
+        delta['counts'] = new['counts']
+
+    prev = old['scoreboard'] if old else {}
+    rows = [r for name, r in new['scoreboard'].items() if prev.get(name) != r]
+    if rows:
+        delta['scoreboard'] = rows
+    return delta
+
+
+def format_event(kind, data):
+    return b'event: ' + kind.encode() + b'\ndata: ' + orjson.dumps(data) + b'\n\n'
+
+
+class Hub:
+    """
+    fan out report updates to the /events subscribers.
+
+    write paths call notify(), which only sets a flag so it is safe from any thread. every
+    EVENT_DEBOUNCE seconds, and only while someone is subscribed, the hub recomputes the reports
+    once if the flag is set or if the database changed underneath it (another worker wrote),
+    and pushes the delta to every subscriber
+    """
+
+    def __init__(self, interval=None):
+        self.interval = interval or settings.EVENT_DEBOUNCE
+        self.state = None
+        self._subscribers = set()
+        self._dirty = True
+        self._version = None
+        self._task = None
+
+    def notify(self):
+        self._dirty = True
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_event_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def subscribe(self):
+        if self.state is None or not self._subscribers:
+            await self._refresh()
+
+        q = asyncio.Queue(maxsize=32)
+        self._subscribers.add(q)
+        return q
+
+    def unsubscribe(self, q):
+        self._subscribers.discard(q)
+
+    async def _refresh(self):
+        v = await run_in_threadpool(version)
+        if not self._dirty and v == self._version and self.state is not None:
+            return
+
+        self._dirty = False
+        self._version = v
+        state = await run_in_threadpool(snapshot)
+        delta = diff(self.state, state)
+        self.state = state
+        return delta
+
+    async def _run(self):
+        while 1:
+            await asyncio.sleep(self.interval)
+            if not self._subscribers:
+                continue
+            try:
+                delta = await self._refresh()
+            except Exception as e:
+                print('event hub refresh failed', e)
+                continue
+            if delta:
+                self._publish(('update', delta))
+
+    def _publish(self, event):
+        for q in list(self._subscribers):
+            try:
+                q.put_nowait(event)
+            except asyncio.QueueFull:
+                # slow consumer, drop what it has not read and resync it with a full snapshot
+                while not q.empty():
+                    q.get_nowait()
+                q.put_nowait(('snapshot', self.snapshot_event()))
+
+    def snapshot_event(self):
+        return {'counts': self.state['counts'],
+                'scoreboard': list(self.state['scoreboard'].values())}
+
+    async def stream(self, request):
+        q = await self.subscribe()
+        try:
+            yield format_event('snapshot', self.snapshot_event())
+            while 1:
+                if await request.is_disconnected():
+                    break
+                try:
+                    kind, data = await asyncio.wait_for(q.get(), KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield b': keepalive\n\n'
+                    continue
+                yield format_event(kind, data)
+        finally:
+            self.unsubscribe(q)
+
+
+hub = Hub()
+
+# ============= EOF =============================================
@@ -0,0 +1,246 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import io
+import json
+import os
+import tarfile
+import time
+import zipfile
+from datetime import datetime
+
+from sqlalchemy import func, select
+
+from api.models import Image, Labels, Label, Consensus
+from api.storage import extension, read_blob
+
+FORMATS = ('tar', 'npz', 'jsonl')
+MEDIA_TYPES = {'tar': 'application/x-tar',
+               'npz': 'application/octet-stream',
+               'jsonl': 'application/x-ndjson'}
+
+METADATA = ('id', 'hashid', 'codec', 'loadname', 'trayname', 'hole_id', 'sample', 'material', 'project',
+            'identifier', 'zoom_level', 'create_date')
+
+
+class StreamBuffer:
+    """
+    write-only file object. whatever tarfile/zipfile write into it is handed back by drain so the
+    archive can be yielded piece by piece instead of being built in memory
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        b = b''.join(self._chunks)
+        self._chunks = []
+        return b
+
+
+def current_cursor(db):
+    return db.query(func.max(Labels.id)).scalar() or 0
+
+
+def query_images(db, label=None, loadname=None, trayname=None, start=None, end=None, since=None,
+                 cursor=None):
+    labeled = select(Labels.image_id)
+    if since:
+        labeled = labeled.where(Labels.id > since)
+    if cursor:
+        labeled = labeled.where(Labels.id <= cursor)
+
+    q = db.query(*(getattr(Image, c) for c in METADATA), Label.name.label('label'))
+    q = q.join(Consensus, Consensus.image_id == Image.id).join(Label, Consensus.label_id == Label.id)
+    q = q.filter(Image.id.in_(labeled))
+    if label:
+        q = q.filter(Label.name == label)
+    if loadname:
+        q = q.filter(Image.loadname == loadname)
+    if trayname:
+        q = q.filter(Image.trayname == trayname)
+    if start:
+        q = q.filter(Image.create_date >= start)
+    if end:
+        q = q.filter(Image.create_date < end)
+    return q.order_by(Image.id)
+
+
+def iter_samples(db, with_blobs=True, chunk=200, **filters):
+    """
+    yield one dict per labeled image with its consensus label. metadata is read through a server
+    side cursor and blobs are fetched one chunk at a time so memory use does not depend on the
+    size of the export
+    """
+    q = query_images(db, **filters).yield_per(chunk)
+
+    batch = []
+    for row in q:
+        batch.append(row)
+        if len(batch) == chunk:
+            yield from _iter_batch(db, batch, with_blobs)
+            batch = []
+    if batch:
+        yield from _iter_batch(db, batch, with_blobs)
+
+
+def _iter_batch(db, batch, with_blobs):
+    blobs = {}
+    if with_blobs:
+        ids = [r.id for r in batch]
+        q = db.query(Image.id, Image.blob, Image.hashid, Image.codec).filter(Image.id.in_(ids))
+        blobs = {r.id: read_blob(r) for r in q}
+
+    for r in batch:
+        sample = {k: getattr(r, k) for k in METADATA}
+        if isinstance(sample['create_date'], datetime):
+            sample['create_date'] = sample['create_date'].isoformat()
+        sample['label'] = r.label
+        if with_blobs:
+            sample['blob'] = blobs.pop(r.id)
+        yield sample
+
+
+def _metadata(sample):
+    return {k: v for k, v in sample.items() if k != 'blob'}
+
+
+def iter_tar(samples):
+    """
+    WebDataset style shard stream. every sample is stored as <key>.tif (or .png), <key>.cls and <key>.json
+    """
+    buf = StreamBuffer()
+    now = time.time()
+    with tarfile.open(fileobj=buf, mode='w|') as tar:
+        for s in samples:
+            key = f"{s['id']:09d}"
+            members = ((extension(s['codec']), s['blob']),
+                       ('cls', (s['label'] or '').encode()),
+                       ('json', json.dumps(_metadata(s)).encode()))
+            for ext, data in members:
+                info = tarfile.TarInfo(f'{key}.{ext}')
+                info.size = len(data)
+                info.mtime = now
+                tar.addfile(info, io.BytesIO(data))
+            yield buf.drain()
+    yield buf.drain()
+
+
+def iter_npz(samples):
+    """
+    npz archive with one uint8 array per image (image_<id>) plus parallel metadata arrays
+    """
+    import numpy as np
+    from PIL import Image as PILImage
+
+    buf = StreamBuffer()
+    meta = {k: [] for k in ('id', 'hole_id', 'label', 'loadname', 'trayname', 'hashid')}
+    with zipfile.ZipFile(buf, mode='w', compression=zipfile.ZIP_STORED) as zf:
+        for s in samples:
+            arr = np.asarray(PILImage.open(io.BytesIO(s['blob'])))
+            with zf.open(f"image_{s['id']}.npy", 'w', force_zip64=True) as wfile:
+                np.lib.format.write_array(wfile, arr, allow_pickle=False)
+            for k, v in meta.items():
+                v.append(s[k])
+            yield buf.drain()
+
+        for k, v in meta.items():
+            with zf.open(f'{k}.npy', 'w', force_zip64=True) as wfile:
+                if k in ('id', 'hole_id'):
+                    arr = np.array([i if i is not None else -1 for i in v], dtype=np.int64)
+                else:
+                    arr = np.array([i or '' for i in v], dtype=str)
+                np.lib.format.write_array(wfile, arr, allow_pickle=False)
+    yield buf.drain()
+
+
+def iter_jsonl(samples):
+    for s in samples:
+        row = _metadata(s)
+        row['url'] = f"/unclassified_image?hashid={s['hashid']}"
+        yield (json.dumps(row) + '\n').encode()
+
+
+WRITERS = {'tar': iter_tar, 'npz': iter_npz, 'jsonl': iter_jsonl}
+
+
+def stream(db, fmt, **kw):
+    samples = iter_samples(db, with_blobs=fmt != 'jsonl', **kw)
+    return WRITERS[fmt](samples)
+
+
+def export_directory(db, root, **kw):
+    """
+    manifest plus files. images are written to <root>/<label>/<id>.<ext> and every sample is
+    appended to <root>/manifest.jsonl
+    """
+    n = 0
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, 'manifest.jsonl'), 'a') as manifest:
+        for s in iter_samples(db, **kw):
+            d = os.path.join(root, s['label'] or 'unknown')
+            os.makedirs(d, exist_ok=True)
+            name = os.path.join(d, f"{s['id']}.{extension(s['codec'])}")
+            with open(name, 'wb') as wfile:
+                wfile.write(s['blob'])
+
+            row = _metadata(s)
+            row['path'] = os.path.relpath(name, root)
+            manifest.write(json.dumps(row) + '\n')
+            n += 1
+    return n
+
+
+def main(argv=None):
+    import argparse
+    from api.session import get_db
+
+    parser = argparse.ArgumentParser(description='Export the labeled dataset')
+    parser.add_argument('out', help='output file, or directory for --format dir')
+    parser.add_argument('--format', default='tar', choices=FORMATS + ('dir',))
+    parser.add_argument('--label')
+    parser.add_argument('--loadname')
+    parser.add_argument('--trayname')
+    parser.add_argument('--start', type=datetime.fromisoformat)
+    parser.add_argument('--end', type=datetime.fromisoformat)
+    parser.add_argument('--since', type=int, help='only images labeled after this export cursor')
+    args = parser.parse_args(argv)
+
+    sess = next(get_db())
+    cursor = current_cursor(sess)
+    kw = dict(label=args.label, loadname=args.loadname, trayname=args.trayname,
+              start=args.start, end=args.end, since=args.since, cursor=cursor)
+
+    if args.format == 'dir':
+        n = export_directory(sess, args.out, **kw)
+        print(f'exported {n} images')
+    else:
+        with open(args.out, 'wb') as wfile:
+            for b in stream(sess, args.format, **kw):
+                wfile.write(b)
+    sess.close()
+    print(f'cursor={cursor}')
+
+
+if __name__ == '__main__':
+    main()
+# ============= EOF =============================================
@@ -0,0 +1,227 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import io
+import os
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import numpy as np
+from PIL import Image as PILImage
+
+from sqlalchemy import func
+
+from api.config import settings
+from api.models import Image, Labels, Label
+from api.storage import read_blob
+
+# feature vector = 16x16 grayscale thumbnail + 32 bin intensity histogram
+THUMB = 16
+NBINS = 32
+DIM = THUMB * THUMB + NBINS
+DTYPE = np.float32
+ROWBYTES = DIM * np.dtype(DTYPE).itemsize
+
+GROW_ROWS = 4096
+CHUNK_ROWS = 16384
+
+
+def compute_feature(buf):
+    img = PILImage.open(io.BytesIO(buf)).convert('L')
+    thumb = np.asarray(img.resize((THUMB, THUMB), PILImage.BILINEAR), dtype=DTYPE).ravel() / 255.
+    hist = np.asarray(img.histogram(), dtype=DTYPE).reshape(NBINS, -1).sum(axis=1)
+    hist /= max(hist.sum(), 1)
+
+    v = np.hstack((thumb - thumb.mean(), hist))
+    n = np.linalg.norm(v)
+    if n:
+        v /= n
+    return v.astype(DTYPE)
+
+
+def nrows(path=None):
+    path = path or settings.FEATURE_PATH
+    if not os.path.isfile(path):
+        return 0
+    return os.path.getsize(path) // ROWBYTES
+
+
+def open_matrix(mode='r', path=None):
+    """
+    memory map the feature matrix. row i holds the unit feature vector of Image.id == i,
+    rows that have not been computed are all zeros
+    """
+    path = path or settings.FEATURE_PATH
+    n = nrows(path)
+    if not n:
+        return np.zeros((0, DIM), dtype=DTYPE)
+    return np.memmap(path, dtype=DTYPE, mode=mode, shape=(n, DIM))
+
+
+def write_features(rows, path=None):
+    """
+    rows: iterable of (image_id, vector)
+    the file only ever grows, it is extended in GROW_ROWS steps so appends rarely resize
+    """
+    rows = list(rows)
+    if not rows:
+        return
+
+    path = path or settings.FEATURE_PATH
+    root = os.path.dirname(path)
+    if root:
+        os.makedirs(root, exist_ok=True)
+
+    need = max(i for i, _ in rows) + 1
+    if nrows(path) < need:
+        size = (need // GROW_ROWS + 1) * GROW_ROWS * ROWBYTES
+        with open(path, 'ab') as wfile:
+            # api and ingest worker processes write concurrently, never let one shrink the file
+            if fcntl is not None:
+                fcntl.flock(wfile, fcntl.LOCK_EX)
+            if os.fstat(wfile.fileno()).st_size < size:
+                wfile.truncate(size)
+
+    mat = open_matrix('r+', path)
+    for i, v in rows:
+        mat[i] = v
+    mat.flush()
+    del mat
+
+
+def add_image_feature(dbim, path=None):
+    write_features([(dbim.id, compute_feature(read_blob(dbim)))], path)
+
+
+def update_features(db, batch=500, path=None):
+    """
+    incrementally compute features for images that are not yet in the matrix.
+    returns the number of vectors written
+    """
+    last = db.query(func.max(Image.id)).scalar() or 0
+
+    mat = open_matrix(path=path)
+    n = min(len(mat), last + 1)
+    ids = []
+    for start in range(1, n, CHUNK_ROWS):
+        block = np.asarray(mat[start:min(start + CHUNK_ROWS, n)])
+        ids.extend((np.flatnonzero(~block.any(axis=1)) + start).tolist())
+    del mat
+
+    ids.extend(i for (i,) in db.query(Image.id).filter(Image.id >= max(n, 1)).order_by(Image.id))
+
+    total = 0
+    for start in range(0, len(ids), batch):
+        chunk = ids[start:start + batch]
+        q = db.query(Image.id, Image.blob, Image.hashid, Image.codec).filter(Image.id.in_(chunk))
+        rows = []
+        for r in q:
+            iid = r.id
+            try:
+                rows.append((iid, compute_feature(read_blob(r))))
+            except (OSError, ValueError) as e:
+                print('failed computing feature', iid, e)
+        write_features(rows, path)
+        total += len(rows)
+    return total
+
+
+def _topk(sims, ids, k):
+    if len(sims) > k:
+        idx = np.argpartition(-sims, k - 1)[:k]
+        sims, ids = sims[idx], ids[idx]
+    order = np.argsort(-sims, kind='stable')
+    return sims[order], ids[order]
+
+
+def search(vector, k=10, candidates=None, exclude=None, path=None):
+    """
+    top-k cosine search. vectors are stored unit normalized so cosine similarity is a dot product.
+    the matrix is scanned in CHUNK_ROWS blocks so only one block is paged in at a time
+
+    candidates: optional array of image ids to restrict the search to
+    """
+    mat = open_matrix(path=path)
+    n = len(mat)
+    best_s = np.zeros(0, dtype=DTYPE)
+    best_i = np.zeros(0, dtype=np.int64)
+    if not n:
+        return best_s, best_i
+
+    if candidates is not None:
+        candidates = np.asarray(candidates, dtype=np.int64)
+        candidates = np.sort(candidates[(candidates > 0) & (candidates < n)])
+        blocks = ((candidates[s:s + CHUNK_ROWS], mat[candidates[s:s + CHUNK_ROWS]])
+                  for s in range(0, len(candidates), CHUNK_ROWS))
+    else:
+        blocks = ((np.arange(s, min(s + CHUNK_ROWS, n)), mat[s:s + CHUNK_ROWS])
+                  for s in range(0, n, CHUNK_ROWS))
+
+    for ids, block in blocks:
+        block = np.asarray(block)
+        sims = block @ vector
+        valid = block.any(axis=1)
+        if exclude is not None:
+            valid &= ids != exclude
+        sims, ids = _topk(sims[valid], ids[valid], k)
+        best_s, best_i = _topk(np.hstack((best_s, sims)), np.hstack((best_i, ids)), k)
+
+    return best_s, best_i
+
+
+def get_vector(image_id, path=None):
+    mat = open_matrix(path=path)
+    if image_id >= len(mat):
+        return
+    v = np.array(mat[image_id])
+    if v.any():
+        return v
+
+
+def labeled_image_ids(db, label):
+    q = db.query(Labels.image_id).join(Label).filter(Label.name == label).distinct()
+    return np.fromiter((i for (i,) in q), dtype=np.int64)
+
+
+def find_similar(db, image_id, k=10, label=None):
+    v = get_vector(image_id)
+    if v is None:
+        dbim = db.query(Image).filter(Image.id == image_id).first()
+        if dbim is None:
+            return
+        v = compute_feature(read_blob(dbim))
+        write_features([(dbim.id, v)])
+
+    candidates = None
+    if label:
+        candidates = labeled_image_ids(db, label)
+
+    sims, ids = search(v, k, candidates=candidates, exclude=image_id)
+    ids = ids.tolist()
+    hashes = dict(db.query(Image.id, Image.hashid).filter(Image.id.in_(ids)))
+    return [{'id': i, 'hashid': hashes.get(i), 'score': float(s)} for i, s in zip(ids, sims)]
+
+
+if __name__ == '__main__':
+    from api.session import get_db
+
+    sess = next(get_db())
+    print('features written', update_features(sess))
+    sess.close()
+
+# ============= EOF =============================================
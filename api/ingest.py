@@ -0,0 +1,256 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+"""
+durable derived data jobs for ingested images.
+
+with INGEST_ASYNC the upload path only stores the bytes as received and enqueues the first stage.
+`python -m api.worker` claims jobs, runs the stage and enqueues the next one, so the stages of an
+image run in STAGES order and never concurrently
+"""
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+
+from api.config import settings
+from api.models import Image, Job
+
+# thumbnail and features read the raw upload, encoding replaces it so it goes last
+STAGES = ('thumbnail', 'features', 'encode')
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def _now():
+    return datetime.utcnow()
+
+
+# ------------------------------------------------------------------------------------- stages
+def stage_thumbnail(db, dbim):
+    from api.storage import make_thumbnail, read_blob
+
+    dbim.thumbnail = make_thumbnail(read_blob(dbim))
+    db.commit()
+
+
+def stage_features(db, dbim):
+    from api import features
+    from api.storage import read_blob
+
+    features.write_features([(dbim.id, features.compute_feature(read_blob(dbim)))])
+
+
+def stage_encode(db, dbim):
+    from api.storage import recompress_image, remove_stale
+
+    if dbim.codec not in (None, 'raw'):
+        return
+
+    on_disk = dbim.blob is None
+    recompress_image(dbim)
+    db.commit()
+    if on_disk and dbim.codec != 'raw':
+        remove_stale(db, [dbim.hashid])
+
+
+STAGE_FUNCS = {'thumbnail': stage_thumbnail,
+               'features': stage_features,
+               'encode': stage_encode}
+
+
+def run_stage(db, image_id, stage):
+    dbim = db.query(Image).filter(Image.id == image_id).first()
+    if dbim is None:
+        raise ValueError(f'image {image_id} not found')
+    STAGE_FUNCS[stage](db, dbim)
+
+
+# ------------------------------------------------------------------------------------- queue
+def pending_count(db):
+    return db.query(func.count(Job.id)).filter(Job.status.in_((PENDING, RUNNING))).scalar()
+
+
+def is_saturated(db):
+    return pending_count(db) >= settings.MAX_PENDING_JOBS
+
+
+def enqueue(db, image_id, stage=STAGES[0], batch_id=None):
+    """
+    add a job, the caller commits
+    """
+    now = _now()
+    job = Job(image_id=image_id, stage=stage, status=PENDING, attempts=0, batch_id=batch_id,
+              create_date=now, available_at=now)
+    db.add(job)
+    return job
+
+
+def claim(db, n, worker):
+    """
+    mark up to n available jobs as running for this worker. the conditional update makes a job
+    go to exactly one worker on any backend, postgres additionally skips rows another worker
+    is claiming instead of waiting for them
+    """
+    now = _now()
+    q = db.query(Job.id).filter(Job.status == PENDING, Job.available_at <= now)
+    q = q.order_by(Job.available_at, Job.id).limit(n)
+    if db.bind.dialect.name == 'postgresql':
+        q = q.with_for_update(skip_locked=True)
+    ids = [i for (i,) in q]
+    if not ids:
+        db.rollback()
+        return []
+
+    db.query(Job).filter(Job.id.in_(ids), Job.status == PENDING).update(
+        {Job.status: RUNNING, Job.claimed_by: worker, Job.start_date: now,
+         Job.attempts: Job.attempts + 1},
+        synchronize_session=False)
+    db.commit()
+
+    q = db.query(Job.id, Job.image_id, Job.stage, Job.attempts)
+    return q.filter(Job.id.in_(ids), Job.claimed_by == worker, Job.status == RUNNING).all()
+
+
+def complete(db, job_id):
+    """
+    mark a job done and enqueue the next stage of its image
+    """
+    job = db.query(Job).filter(Job.id == job_id).one()
+    job.status = DONE
+    job.error = None
+    job.finish_date = _now()
+
+    idx = STAGES.index(job.stage)
+    if idx + 1 < len(STAGES):
+        nxt = STAGES[idx + 1]
+        exists = db.query(Job.id).filter(Job.image_id == job.image_id, Job.stage == nxt).first()
+        if exists is None:
+            enqueue(db, job.image_id, nxt, job.batch_id)
+    db.commit()
+
+
+def fail(db, job_id, error):
+    """
+    retry with exponential backoff until INGEST_MAX_ATTEMPTS, then give up
+    """
+    job = db.query(Job).filter(Job.id == job_id).one()
+    job.error = str(error)[:1000]
+    now = _now()
+    if job.attempts >= settings.INGEST_MAX_ATTEMPTS:
+        job.status = FAILED
+        job.finish_date = now
+    else:
+        job.status = PENDING
+        delay = min(settings.INGEST_BACKOFF * 2 ** (job.attempts - 1), 3600)
+        job.available_at = now + timedelta(seconds=delay)
+    db.commit()
+
+
+def requeue_stale(db, worker=None):
+    """
+    jobs left running by a worker that died, or by an earlier run of this worker
+    """
+    cutoff = _now() - timedelta(seconds=settings.INGEST_JOB_TIMEOUT)
+    stale = Job.start_date < cutoff
+    if worker:
+        stale = stale | (Job.claimed_by == worker)
+    n = db.query(Job).filter(Job.status == RUNNING, stale).update(
+        {Job.status: PENDING, Job.available_at: _now()}, synchronize_session=False)
+    db.commit()
+    return n
+
+
+def retry_failed(db, stage=None):
+    q = db.query(Job).filter(Job.status == FAILED)
+    if stage:
+        q = q.filter(Job.stage == stage)
+    n = q.update({Job.status: PENDING, Job.attempts: 0, Job.available_at: _now()},
+                 synchronize_session=False)
+    db.commit()
+    return n
+
+
+# ------------------------------------------------------------------------------------- reporting
+def _image_state(stages):
+    if any(s['status'] == FAILED for s in stages.values()):
+        return FAILED
+    if all(stages.get(s, {}).get('status') == DONE for s in STAGES):
+        return DONE
+    return 'processing'
+
+
+def status(db, image_ids=None, batch_id=None):
+    """
+    per image stage status. a stage that is not in the table yet is waiting for the one before
+    """
+    q = db.query(Job.image_id, Job.stage, Job.status, Job.attempts, Job.error, Job.batch_id)
+    if batch_id is not None:
+        q = q.filter(Job.batch_id == batch_id)
+    else:
+        q = q.filter(Job.image_id.in_(image_ids))
+
+    images = {}
+    for r in q.order_by(Job.image_id, Job.id):
+        images.setdefault(r.image_id, {})[r.stage] = {'status': r.status,
+                                                      'attempts': r.attempts,
+                                                      'error': r.error}
+
+    rows = []
+    for image_id, stages in images.items():
+        for s in STAGES:
+            stages.setdefault(s, {'status': 'waiting', 'attempts': 0, 'error': None})
+        rows.append({'image_id': image_id, 'status': _image_state(stages), 'stages': stages})
+
+    summary = {DONE: 0, FAILED: 0, 'processing': 0}
+    for r in rows:
+        summary[r['status']] += 1
+    return {'batch_id': batch_id, 'summary': summary, 'images': rows}
+
+
+def metrics(db, window=300):
+    """
+    queue depth and throughput per stage over the last `window` seconds
+    """
+    now = _now()
+    since = now - timedelta(seconds=window)
+
+    stages = {s: {'pending': 0, 'running': 0, 'done': 0, 'failed': 0} for s in STAGES}
+    for stage, st, n in db.query(Job.stage, Job.status, func.count(Job.id)).group_by(Job.stage, Job.status):
+        stages.setdefault(stage, {})[st] = n
+
+    for stage, oldest in db.query(Job.stage, func.min(Job.available_at)).filter(
+            Job.status == PENDING).group_by(Job.stage):
+        stages[stage]['oldest_pending_s'] = round(max((now - oldest).total_seconds(), 0), 1)
+
+    q = db.query(Job.stage, Job.start_date, Job.finish_date).filter(Job.status == DONE,
+                                                                   Job.finish_date >= since)
+    durations = {}
+    for stage, st, ft in q:
+        durations.setdefault(stage, []).append((ft - st).total_seconds())
+
+    for stage, ds in durations.items():
+        ds.sort()
+        stages[stage].update({'done_per_s': round(len(ds) / window, 3),
+                              'mean_s': round(sum(ds) / len(ds), 4),
+                              'p95_s': round(ds[min(len(ds) - 1, int(0.95 * len(ds)))], 4)})
+
+    return {'window_s': window,
+            'pending_limit': settings.MAX_PENDING_JOBS,
+            'stages': stages}
+
+# ============= EOF =============================================
@@ -0,0 +1,138 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+from datetime import datetime
+
+from sqlalchemy import or_
+from sqlalchemy.exc import DBAPIError, IntegrityError
+
+from api import achievements, cache, changes, consensus
+from api.models import Image, Labels, User
+
+
+def _resolve_images(db, events):
+    ids = {e['image_id'] for e in events if e.get('image_id') is not None}
+    hashes = {e['hashid'] for e in events if e.get('image_id') is None and e.get('hashid')}
+
+    by_id, by_hash = {}, {}
+    if ids or hashes:
+        q = db.query(Image.id, Image.hashid).filter(or_(Image.id.in_(ids), Image.hashid.in_(hashes)))
+        for iid, ha in q:
+            by_id[iid] = iid
+            by_hash[ha] = iid
+    return by_id, by_hash
+
+
+def _resolve_users(db, names):
+    users = cache.users.get(db, names)
+    new = [User(name=name) for name in names if name not in users]
+    if new:
+        db.add_all(new)
+        db.flush()
+        cache.users.invalidate(db)
+        users.update((u.name, u) for u in new)
+    return users
+
+
+def _apply(db, events):
+    results = [None] * len(events)
+
+    keys = [e.get('client_event_id') for e in events]
+    seen = {k for (k,) in db.query(Labels.client_event_id).filter(Labels.client_event_id.in_(
+        [k for k in keys if k]))}
+
+    labels = {name: row.id for name, row in cache.labels.get(db, {e['label'] for e in events}).items()}
+    by_id, by_hash = _resolve_images(db, events)
+
+    todo = []
+    for i, e in enumerate(events):
+        key = keys[i]
+        if key and key in seen:
+            results[i] = {'status': 'duplicate'}
+            continue
+
+        if e.get('image_id') is not None:
+            image_id = by_id.get(e['image_id'])
+        else:
+            image_id = by_hash.get(e.get('hashid'))
+
+        if image_id is None:
+            results[i] = {'status': 'error', 'detail': 'image not found'}
+        elif e['label'] not in labels:
+            results[i] = {'status': 'error', 'detail': f"label {e['label']} not found"}
+        else:
+            if key:
+                seen.add(key)
+            todo.append((i, image_id, labels[e['label']], e.get('user') or 'default', key))
+
+    if todo:
+        users = _resolve_users(db, {user for _, _, _, user, _ in todo})
+        now = datetime.utcnow()
+        rows = []
+        for i, image_id, label_id, user, key in todo:
+            u = users[user]
+            row = Labels(image_id=image_id, label_id=label_id, user_id=u.id, client_event_id=key,
+                         create_date=now)
+            db.add(row)
+            rows.append((i, row))
+
+        # judged against the votes before this batch, so before they are added
+        achievements.record_labels(db, [(users[user].id, image_id, label_id)
+                                        for _, image_id, label_id, user, _ in todo], now)
+        consensus.add_votes(db, [(image_id, label_id, users[user].reliability)
+                                 for _, image_id, label_id, user, _ in todo])
+        db.flush()
+        for i, row in rows:
+            results[i] = {'status': 'created', 'id': row.id, 'image_id': row.image_id}
+        changes.record(db, 'label', [row.id for _, row in rows])
+
+    db.commit()
+    return results
+
+
+def apply_labels(db, events):
+    """
+    insert a batch of labels in one transaction.
+
+    events: sequence of dicts with image_id or hashid, label, user and an optional
+    client_event_id. a client_event_id that was already stored is reported as a duplicate and not
+    inserted again, so clients can safely resend a batch.
+
+    returns one result dict per event, in order, with status created, duplicate or error
+    """
+    events = [dict(e) for e in events]
+    for e in events:
+        e.setdefault('client_event_id', None)
+
+    try:
+        results = _apply(db, events)
+    except IntegrityError:
+        # a concurrent request stored one of our client_event_ids first. run again, those are now
+        # reported as duplicates
+        db.rollback()
+        results = _apply(db, events)
+    except DBAPIError as e:
+        # e.g. a deadlock or lock timeout, the database rolled this transaction back. a lost
+        # connection is not worth retrying
+        if e.connection_invalidated:
+            raise
+        db.rollback()
+        results = _apply(db, events)
+
+    for e, r in zip(events, results):
+        r['client_event_id'] = e['client_event_id']
+    return results
+
+# ============= EOF =============================================
@@ -0,0 +1,85 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+from datetime import datetime
+
+from sqlalchemy import select
+
+from api.models import Image, Labels, Label, User
+
+COLUMNS = ('id', 'hashid', 'loadname', 'trayname', 'hole_id', 'sample', 'material', 'project',
+           'identifier', 'zoom_level', 'nxtals', 'weight', 'note', 'create_date')
+
+MAX_LIMIT = 1000
+
+
+def filter_images(q, loadname=None, trayname=None, sample=None, material=None,
+                  label=None, user=None, start=None, end=None):
+    if loadname:
+        q = q.filter(Image.loadname == loadname)
+    if trayname:
+        q = q.filter(Image.trayname == trayname)
+    if sample:
+        q = q.filter(Image.sample == sample)
+    if material:
+        q = q.filter(Image.material == material)
+    if start:
+        q = q.filter(Image.create_date >= start)
+    if end:
+        q = q.filter(Image.create_date < end)
+
+    if label or user:
+        sq = select(Labels.id).where(Labels.image_id == Image.id)
+        if label:
+            sq = sq.join(Label, Labels.label_id == Label.id).where(Label.name == label)
+        if user:
+            sq = sq.join(User, Labels.user_id == User.id).where(User.name == user)
+        q = q.filter(sq.exists())
+    return q
+
+
+def list_images(db, after=None, limit=100, order='asc', **filters):
+    """
+    keyset pagination on Image.id. returns (rows, next_cursor), next_cursor is None on the
+    last page
+    """
+    limit = max(1, min(limit, MAX_LIMIT))
+
+    q = db.query(*(getattr(Image, c) for c in COLUMNS))
+    q = filter_images(q, **filters)
+    if order == 'desc':
+        if after is not None:
+            q = q.filter(Image.id < after)
+        q = q.order_by(Image.id.desc())
+    else:
+        if after is not None:
+            q = q.filter(Image.id > after)
+        q = q.order_by(Image.id.asc())
+
+    records = q.limit(limit + 1).all()
+    cursor = None
+    if len(records) > limit:
+        records = records[:limit]
+        cursor = records[-1].id
+
+    rows = []
+    for r in records:
+        row = {c: getattr(r, c) for c in COLUMNS}
+        if isinstance(row['create_date'], datetime):
+            row['create_date'] = row['create_date'].isoformat()
+        rows.append(row)
+    return rows, cursor
+
+# ============= EOF =============================================
@@ -18,19 +18,25 @@ import hashlib
 import io
 import json
 import os
+import uuid
+from datetime import datetime
 from typing import List, Optional
 
-from fastapi import FastAPI, Depends, HTTPException, APIRouter, Response
+from fastapi import FastAPI, Depends, HTTPException, APIRouter, Query, Response, Request
 
-from sqlalchemy import func, distinct, select
+from sqlalchemy import func, select
 from sqlalchemy.exc import NoResultFound
 from sqlalchemy.orm import Session
 from starlette.middleware.cors import CORSMiddleware
-from starlette.responses import JSONResponse
+from starlette.responses import FileResponse, StreamingResponse
 
-from api import schemas
-from api.models import Label, Image, Labels, User
-from api.session import get_db
+from api import schemas, export, storage, listing, consensus, reports, labeling, cache, streaming, ingest, \
+    achievements, changes
+from api.config import settings
+from api.models import Image, Labels, Consensus
+from api.events import hub
+from api.responses import ORJSONResponse, negotiate
+from api.session import get_db, pool_stats
 
 # tags_metadata = [
 #     {"name": "wells", "description": "Water Wells"},
@@ -46,6 +52,7 @@ app = FastAPI(
     # description=description,
     # openapi_tags=tags_metadata,
     version="0.0.1",
+    default_response_class=ORJSONResponse,
 )
 origins = [
     "http://localhost",
@@ -64,13 +71,40 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-from api.db import setup_db
 
-setup_db()
+
+@app.on_event('startup')
+async def startup():
+    hub.start()
+
+
+@app.on_event('shutdown')
+async def shutdown():
+    await hub.stop()
+
+
+@app.get('/events')
+async def get_events(request: Request):
+    """
+    server sent events. a `snapshot` event with the counts and the scoreboard on connect, then
+    `update` events with whatever changed
+    """
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return StreamingResponse(hub.stream(request), media_type='text/event-stream', headers=headers)
+
+
+@app.get('/health')
+async def get_health():
+    return {'status': 'ok', 'pid': os.getpid(), 'db_pool': pool_stats()}
 
 
 @app.post('/add_unclassified_image')
-async def add_unclassified_image(payload: schemas.UnclassifiedImage, db: Session = Depends(get_db)):
+def add_unclassified_image(payload: schemas.UnclassifiedImage, request: Request, batch_id: str = None,
+                           db: Session = Depends(get_db)):
+    if settings.INGEST_ASYNC and ingest.is_saturated(db):
+        raise HTTPException(status_code=503, detail='ingest queue is full',
+                            headers={'Retry-After': '5'})
+
     img = base64.b64decode(payload.image.encode())
 
     ha = hashlib.sha256(img).hexdigest()
@@ -78,78 +112,173 @@ async def add_unclassified_image(payload: schemas.UnclassifiedImage, db: Session
     q = db.query(Image)
     try:
         q = q.filter(Image.hashid == ha)
-        q.one()
+        dbim = q.one()
+        if settings.INGEST_ASYNC:
+            return negotiate(request, {'id': dbim.id, 'hashid': ha, 'duplicate': True})
         return
     except NoResultFound:
         pass
 
     payloadargs = payload.dict(exclude={'image', })
 
-    dbim = Image(blob=img, hashid=ha, **payloadargs)
+    if settings.INGEST_ASYNC:
+        # store the bytes as received, the worker makes the thumbnail, features and encoding
+        dbim = storage.new_image(img, hashid=ha, derive=False, **payloadargs)
+        db.add(dbim)
+        db.flush()
+        ingest.enqueue(db, dbim.id, batch_id=batch_id)
+        changes.record(db, 'image', [dbim.id])
+        db.commit()
+        hub.notify()
+        return negotiate(request, {'id': dbim.id, 'hashid': ha, 'batch_id': batch_id,
+                                   'status_url': f'/ingest/status?image_id={dbim.id}'}, status_code=202)
+
+    dbim = storage.new_image(img, hashid=ha, **payloadargs)
     db.add(dbim)
+    db.flush()
+    changes.record(db, 'image', [dbim.id])
     db.commit()
+    hub.notify()
 
+    from api import features
 
-@app.post('/label/{image_id}')
-async def add_label(image_id: str, label: str = 'good', user: str = 'default', db: Session = Depends(get_db)):
-    q = db.query(Image)
-    image = q.filter(Image.id == image_id).first()
-    label = db.query(Label).filter(Label.name == label).first()
     try:
-        user = db.query(User).filter(User.name == user).one()
-    except NoResultFound:
-        print('no user found', user)
-        user = User(name=user)
-        db.add(user)
-        db.commit()
+        features.add_image_feature(dbim)
+    except (OSError, ValueError) as e:
+        print('failed computing feature', dbim.id, e)
+
+
+@app.post('/add_tray_image')
+def add_tray_image(payload: schemas.TrayImage, request: Request, batch_id: str = None,
+                   db: Session = Depends(get_db)):
+    # numpy/PIL are only imported by the endpoints that need them to keep app startup fast
+    from api import features, tray
+
+    holes = [(h.hole_id, h.x, h.y) for h in payload.holes or ()]
+    radius = payload.radius
+    if payload.template:
+        template = tray.load_template(payload.template)
+        if template is None:
+            raise HTTPException(status_code=404, detail=f'no tray template named {payload.template}')
+        if not holes:
+            holes = template[0]
+        if radius is None:
+            radius = template[1]
+
+    if not holes or radius is None:
+        raise HTTPException(status_code=422, detail='holes and radius or a template are required')
 
-    label = Labels(label=label, image=image, user=user)
-    db.add(label)
+    img = base64.b64decode(payload.image.encode())
+    payloadargs = payload.dict(exclude={'image', 'template', 'holes', 'radius', 'margin'})
+    if settings.INGEST_ASYNC and ingest.is_saturated(db):
+        raise HTTPException(status_code=503, detail='ingest queue is full',
+                            headers={'Retry-After': '5'})
+    try:
+        rows, skipped = tray.add_tray(db, img, holes, radius, payload.margin,
+                                      derive=not settings.INGEST_ASYNC, **payloadargs)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+    # the holes and their ingest jobs commit together, a hole is never left without its jobs
+    created = [dbim for _, dbim, c in rows if c]
+    if settings.INGEST_ASYNC:
+        # one batch per tray so its jobs can be followed together
+        batch_id = batch_id or uuid.uuid4().hex
+        for dbim in created:
+            ingest.enqueue(db, dbim.id, batch_id=batch_id)
     db.commit()
+    hub.notify()
+
+    if not settings.INGEST_ASYNC:
+        try:
+            features.write_features((dbim.id, features.compute_feature(storage.read_blob(dbim)))
+                                    for dbim in created)
+        except (OSError, ValueError) as e:
+            print('failed computing features', e)
+
+    obj = {'table': [{'hole_id': hole_id,
+                      'id': dbim.id,
+                      'hashid': dbim.hashid,
+                      'created': c} for hole_id, dbim, c in rows],
+           # holes that run off the edge of the tray image
+           'skipped': skipped}
+    if settings.INGEST_ASYNC and created:
+        obj['batch_id'] = batch_id
+        obj['status_url'] = f'/ingest/status?batch_id={batch_id}'
+        return negotiate(request, obj, status_code=202)
+    return negotiate(request, obj)
+
+
+@app.post('/label/{image_id}')
+def add_label(image_id: int, label: str = 'good', user: str = 'default', db: Session = Depends(get_db)):
+    result = labeling.apply_labels(db, [{'image_id': image_id, 'label': label, 'user': user}])[0]
+    if result['status'] == 'error':
+        raise HTTPException(status_code=404, detail=result['detail'])
+    hub.notify()
+
+
+@app.post('/labels/batch')
+def add_labels(events: List[schemas.LabelEvent], request: Request, db: Session = Depends(get_db)):
+    results = labeling.apply_labels(db, [e.dict() for e in events])
+    if any(r['status'] == 'created' for r in results):
+        hub.notify()
+    return negotiate(request, {'table': results})
 
 
 @app.get('/representative_images')
-def get_representative_images(db: Session = Depends(get_db)):
+def get_representative_images(request: Request, db: Session = Depends(get_db)):
     # subquery = db.query(Labels.id).order_by(Labels.label_id).distinct(Labels.label_id).subquery()
     # q = db.query(Labels).filter(Labels.id.in_(select(subquery)))
-    subquery = db.query(Labels.id).distinct(Labels.label_id).order_by(Labels.label_id.desc(),
-                                                                      Labels.id.desc()).subquery()
+    # newest label of every kind. max per group instead of DISTINCT ON so it also runs on sqlite
+    subquery = db.query(func.max(Labels.id)).group_by(Labels.label_id).subquery()
 
     q = db.query(Labels).filter(Labels.id.in_(select(subquery))).order_by(Labels.id)
 
     records = q.all()
-    for r in records:
-        print(r.id)
     obj = [{'label': i.label.name,
             # 'name': i.image.name,
-            'image': base64.b64encode(i.image.blob).decode()} for i in q.all()]
-    return JSONResponse(content=obj)
+            'image': storage.read_blob(i.image)} for i in records]
+    return negotiate(request, obj)
 
 
-@app.get('/users', response_model=List[schemas.User])
-async def get_users(db: Session = Depends(get_db)):
-    return db.query(User).all()
+@app.get('/similar/{image_id}')
+def get_similar(image_id: int, request: Request, k: int = 10, label: str = None, db: Session = Depends(get_db)):
+    from api import features
 
+    rows = features.find_similar(db, image_id, k, label)
+    if rows is None:
+        raise HTTPException(status_code=404, detail=f'image {image_id} not found')
+    return negotiate(request, {'image_id': image_id, 'table': rows})
 
-def fetch_badges(user):
-    badges = []
-    if user == 'jake':
-        badges.append('😎')
-    if user == 'MZimmerer':
-        badges.append('🤓')
-    return badges
 
+@app.get('/export')
+def export_dataset(fmt: str = 'tar',
+                   label: str = None,
+                   loadname: str = None,
+                   trayname: str = None,
+                   start: datetime = None,
+                   end: datetime = None,
+                   since: int = None,
+                   db: Session = Depends(get_db)):
+    if fmt not in export.FORMATS:
+        raise HTTPException(status_code=400, detail=f'fmt must be one of {export.FORMATS}')
 
-@app.get('/scoreboard')
-async def get_scoreboard(user: str = None, db: Session = Depends(get_db)):
-    q = db.query(Labels.user_id, func.count(Labels.user_id))
-    q = q.group_by(Labels.user_id)
-    records = q.all()
-    names = [db.query(User).filter(User.id == u).first().name for u, c in records]
-    rows = [{'name': ni,
-             'total': c,
-             'badges': fetch_badges(ni)} for ni, (u, c) in zip(names, records)]
+    cursor = export.current_cursor(db)
+    content = export.stream(db, fmt, label=label, loadname=loadname, trayname=trayname,
+                            start=start, end=end, since=since, cursor=cursor)
+    headers = {'X-Export-Cursor': str(cursor),
+               'Content-Disposition': f'attachment; filename="trayclassifier-{cursor}.{fmt}"'}
+    return StreamingResponse(content, media_type=export.MEDIA_TYPES[fmt], headers=headers)
+
+
+@app.get('/users', response_model=List[schemas.User])
+async def get_users(request: Request, db: Session = Depends(get_db)):
+    return negotiate(request, [{'id': u.id, 'name': u.name} for u in cache.users.all(db)])
 
+
+@app.get('/scoreboard')
+async def get_scoreboard(request: Request, user: str = None, db: Session = Depends(get_db)):
+    rows = reports.scoreboard_rows(db)
     rows = sorted(rows, key=lambda x: x['total'], reverse=True)
 
     if user:
@@ -159,47 +288,128 @@ async def get_scoreboard(user: str = None, db: Session = Depends(get_db)):
             rows.insert(0, row)
 
     obj = {'table': rows}
-    return JSONResponse(content=obj)
+    return negotiate(request, obj)
 
 
-def get_users_report(db, user):
-    q = db.query(Labels.label_id,
-                 func.count(Labels.label_id)).join(User)
+@app.get('/user_report/{user}')
+async def get_user_report(user: str, request: Request, db: Session = Depends(get_db)):
+    rows = reports.get_users_report(db, user)
+    obj = {'table': rows}
+    return negotiate(request, obj)
 
-    if user:
-        q = q.filter(User.name == user)
-    records = q.group_by(Labels.label_id).all()
-    rows = [{'label': db.query(Label).filter(Label.id == l).first().name, 'count': c} for l, c in records]
-    return rows
 
+@app.get('/achievements')
+async def get_achievements(request: Request, db: Session = Depends(get_db)):
+    rows = [{'name': r.name, 'badge': r.badge, 'description': r.description}
+            for r in cache.achievements.all(db)]
+    return negotiate(request, {'table': rows})
 
-@app.get('/user_report/{user}')
-async def get_user_report(user: str, db: Session = Depends(get_db)):
-    rows = get_users_report(db, user)
-    obj = {'table': rows}
-    return JSONResponse(content=obj)
+
+@app.get('/achievements/{user}')
+async def get_user_achievements(user: str, request: Request, db: Session = Depends(get_db)):
+    """
+    a labeler's running stats and every achievement with when it was awarded
+    """
+    obj = achievements.user_achievements(db, user)
+    if obj is None:
+        raise HTTPException(status_code=404, detail=f'no user {user}')
+    return negotiate(request, obj)
 
 
 @app.get('/results_report')
-async def get_result_report(db: Session = Depends(get_db)):
-    rows = get_users_report(db, None)
-    total = db.query(Image).count()
-    classified = db.query(Labels.image_id).group_by(Labels.image_id).count()
+async def get_result_report(request: Request, db: Session = Depends(get_db)):
+    obj = reports.results_report(db)
+    return negotiate(request, obj)
+
 
-    obj = {'table': rows,
-           'total': total,
-           'unclassified': total - classified}
-    return JSONResponse(content=obj)
+@app.get('/consensus/{image_id}')
+async def get_consensus(image_id: int, request: Request, db: Session = Depends(get_db)):
+    c = db.query(Consensus).filter(Consensus.image_id == image_id).first()
+    if c is None:
+        raise HTTPException(status_code=404, detail=f'no labels for image {image_id}')
+
+    ids = {c.label_id, *(int(k) for k in (c.weights or {}))}
+    names = cache.labels.names(db, ids)
+    return negotiate(request, consensus.to_dict(c, names))
+
+
+@app.post('/consensus/recompute')
+def recompute_consensus(request: Request, weighted: bool = False, db: Session = Depends(get_db)):
+    n = consensus.recompute(db, weighted)
+    hub.notify()
+    return negotiate(request, {'images': n})
 
 
 @app.get('/labels', response_model=List[schemas.Label])
-async def get_labels(db: Session = Depends(get_db)):
-    q = db.query(Label)
-    return q.all()
+async def get_labels(request: Request, db: Session = Depends(get_db)):
+    return negotiate(request, [{'id': l.id, 'name': l.name} for l in cache.labels.all(db)])
+
+
+@app.get('/trays')
+def get_trays(request: Request, db: Session = Depends(get_db)):
+    from api import mosaic
+
+    return negotiate(request, {'table': mosaic.list_trays(db)})
+
+
+@app.get('/tray_mosaic')
+def get_tray_mosaic(loadname: str, trayname: str, request: Request, cols: int = None,
+                    db: Session = Depends(get_db)):
+    """
+    where every hole of a tray is in the /tray_mosaic.png image, with its labels
+    """
+    from api import mosaic
+
+    version, png, obj = mosaic.get_mosaic(db, loadname, trayname, cols)
+    if not obj['holes']:
+        raise HTTPException(status_code=404, detail=f'no images for tray {loadname}/{trayname}')
+    return negotiate(request, obj, headers={'ETag': f'"{obj["version"]}"'})
+
+
+@app.get('/tray_mosaic.png',
+         responses={200: {"content": {"image/png": {}}}},
+         response_class=Response)
+def get_tray_mosaic_png(loadname: str, trayname: str, request: Request, cols: int = None,
+                        db: Session = Depends(get_db)):
+    from api import mosaic
+
+    version, png, obj = mosaic.get_mosaic(db, loadname, trayname, cols)
+    if not obj['holes']:
+        raise HTTPException(status_code=404, detail=f'no images for tray {loadname}/{trayname}')
+
+    etag = f'"{obj["version"]}"'
+    if request.headers.get('if-none-match') == etag:
+        return Response(status_code=304, headers={'ETag': etag})
+    return Response(content=png, media_type='image/png', headers={'ETag': etag})
+
+
+@app.get('/images')
+async def get_images(request: Request,
+                     loadname: str = None,
+                     trayname: str = None,
+                     sample: str = None,
+                     material: str = None,
+                     label: str = None,
+                     user: str = None,
+                     start: datetime = None,
+                     end: datetime = None,
+                     after: int = None,
+                     limit: int = 100,
+                     order: str = 'asc',
+                     db: Session = Depends(get_db)):
+    if order not in ('asc', 'desc'):
+        raise HTTPException(status_code=400, detail='order must be asc or desc')
+
+    rows, cursor = listing.list_images(db, after=after, limit=limit, order=order,
+                                       loadname=loadname, trayname=trayname, sample=sample,
+                                       material=material, label=label, user=user,
+                                       start=start, end=end)
+    obj = {'table': rows, 'next': cursor}
+    return negotiate(request, obj)
 
 
 @app.get('/unclassified_image_info', response_model=Optional[schemas.ImageInfo])
-async def get_image_info(image_id: int = None, hashid: str = None, db: Session = Depends(get_db)):
+async def get_image_info(request: Request, image_id: int = None, hashid: str = None, db: Session = Depends(get_db)):
     q = db.query(Image)
     if hashid:
         q = q.filter(Image.hashid == hashid)
@@ -210,8 +420,10 @@ async def get_image_info(image_id: int = None, hashid: str = None, db: Session =
         q = q.filter(Labels.id == None)
         q = q.order_by(Image.id.asc())
 
-    # img = q.first()
-    return q.first()
+    img = q.first()
+    if img is not None:
+        img = schemas.ImageInfo.from_orm(img).dict()
+    return negotiate(request, img)
 
 
 @app.get('/unclassified_image',
@@ -221,13 +433,138 @@ async def get_image_info(image_id: int = None, hashid: str = None, db: Session =
              }
          },
          response_class=Response)
-async def get_image(hashid: str = None, db: Session = Depends(get_db)):
-    q = db.query(Image)
-    if hashid:
-        q = q.filter(Image.hashid == hashid)
-    else:
-        pass
+def get_image(request: Request, hashid: str = None, db: Session = Depends(get_db)):
+    """
+    streamed in chunks, supports Range requests
+    """
+    row = streaming.image_row(db, hashid)
+    # the bytes are read with their own short lived sessions, don't hold this connection while
+    # the client downloads
+    db.close()
+    if row is None:
+        raise HTTPException(status_code=404, detail=f'no image {hashid}')
+    return streaming.image_response(request, row)
+
 
-    dbim = q.first()
-    return Response(content=dbim.blob, media_type="image/tiff")
+# tiles of an image never change, its hashid is the hash of its bytes
+TILE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+def _pyramid(db, hashid):
+    from api import tiles
+
+    try:
+        obj = tiles.get_pyramid(db, hashid)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if obj is None:
+        raise HTTPException(status_code=404, detail=f'no image {hashid}')
+    return obj
+
+
+@app.get('/tiles/{hashid}.json')
+def get_tile_source(hashid: str, request: Request, db: Session = Depends(get_db)):
+    """
+    deep zoom descriptor as an OpenSeadragon tile source. the pyramid is built on first use
+    """
+    from api import tiles
+
+    obj = _pyramid(db, hashid)
+    url = f'{str(request.base_url).rstrip("/")}/tiles/{hashid}_files/'
+    return ORJSONResponse(tiles.descriptor(obj, url), headers={'Cache-Control': TILE_CACHE_CONTROL})
+
+
+@app.get('/tiles/{hashid}.dzi',
+         responses={200: {"content": {"application/xml": {}}}},
+         response_class=Response)
+def get_tile_dzi(hashid: str, db: Session = Depends(get_db)):
+    from api import tiles
+
+    obj = _pyramid(db, hashid)
+    return Response(content=tiles.descriptor_xml(obj), media_type='application/xml',
+                    headers={'Cache-Control': TILE_CACHE_CONTROL})
+
+
+@app.get('/tiles/{hashid}_files/{level:int}/{col:int}_{row:int}.{fmt}',
+         responses={200: {"content": {"image/png": {}, "image/jpeg": {}}}},
+         response_class=Response)
+def get_tile(hashid: str, level: int, col: int, row: int, fmt: str, db: Session = Depends(get_db)):
+    from api import tiles
+
+    obj = _pyramid(db, hashid)
+    try:
+        path = tiles.get_tile(db, hashid, level, col, row, fmt, obj)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    finally:
+        # tiles are plain files, don't hold the connection while one is sent
+        db.close()
+    if path is None:
+        raise HTTPException(status_code=404, detail=f'no tile {level}/{col}_{row}.{fmt}')
+    return FileResponse(path, media_type=tiles.MEDIA_TYPES[fmt], headers={'Cache-Control': TILE_CACHE_CONTROL})
+
+
+@app.get('/ingest/status')
+def get_ingest_status(request: Request, image_id: int = None, hashid: str = None, batch_id: str = None,
+                      db: Session = Depends(get_db)):
+    if batch_id is not None:
+        obj = ingest.status(db, batch_id=batch_id)
+    else:
+        if hashid:
+            image_id = db.query(Image.id).filter(Image.hashid == hashid).scalar()
+        if image_id is None:
+            raise HTTPException(status_code=422, detail='image_id, hashid or batch_id is required')
+        obj = ingest.status(db, image_ids=[image_id])
+
+    if not obj['images']:
+        raise HTTPException(status_code=404, detail='no ingest jobs found')
+    return negotiate(request, obj)
+
+
+@app.get('/ingest/metrics')
+def get_ingest_metrics(request: Request, window: int = 300, db: Session = Depends(get_db)):
+    return negotiate(request, ingest.metrics(db, window))
+
+
+@app.get('/analytics/groupby')
+def get_analytics_groupby(request: Request, table: str = 'labels', by: str = '',
+                          agg: List[str] = Query([]), limit: int = None):
+    """
+    counts per group from the parquet snapshot, e.g. ?table=labels&by=material,label&user=jake.
+    any other query parameter naming a column of the table is an equality filter.
+    agg=column:op adds sum, mean, min, max or count_distinct of a column
+    """
+    from api import analytics
+
+    reserved = {'table', 'by', 'agg', 'limit'}
+    filters = {k: v for k, v in request.query_params.items() if k not in reserved}
+    try:
+        obj = analytics.groupby(table, by.split(','), filters, agg, limit)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if obj is None:
+        raise HTTPException(status_code=404, detail='no analytics snapshot, run python -m api.analytics')
+    return negotiate(request, obj)
+
+
+@app.get('/changes')
+async def get_changes(request: Request, since: int = 0, limit: int = None, kind: str = None, wait: float = 0):
+    """
+    images and labels inserted after the cursor `since`, oldest first. pass the returned cursor
+    as since to resume, more means call again right away. kind=label or kind=image filters,
+    wait holds the request up to that many seconds (at most CHANGES_MAX_WAIT) until there is one
+    """
+    kinds = [k for k in (kind or '').split(',') if k]
+    bad = [k for k in kinds if k not in changes.KINDS]
+    if bad:
+        raise HTTPException(status_code=422, detail=f'unknown kind {bad[0]}, use {" or ".join(changes.KINDS)}')
+
+    obj = await changes.poll(since, limit, kinds, wait)
+    return negotiate(request, obj)
+
+
+@app.get('/storage_report')
+async def get_storage_report(request: Request, db: Session = Depends(get_db)):
+    obj = {'table': storage.storage_report(db)}
+    return negotiate(request, obj)
 # ============= EOF =============================================
@@ -24,10 +24,13 @@ from sqlalchemy import (
     ForeignKey,
     Float,
     BLOB,
+    Date,
     DateTime,
+    JSON,
     LargeBinary,
     func,
     Boolean,
+    Index,
 )
 
 
@@ -44,10 +47,36 @@ class Base:
 
 class User(Base):
     name = Column(String)
+    reliability = Column(Float)
 
 
 class Achievement(Base):
-    name = Column(String)
+    # one row per rule in api.achievements.RULES
+    name = Column(String, unique=True)
+    badge = Column(String)
+    description = Column(String)
+
+
+class UserAchievement(Base):
+    user_id = Column(Integer, ForeignKey('User.id'))
+    achievement_id = Column(Integer, ForeignKey('Achievement.id'))
+    award_date = Column(DateTime)
+
+    __table_args__ = (Index('ix_UserAchievement_user_id_achievement_id', 'user_id', 'achievement_id',
+                            unique=True),)
+
+
+class UserStats(Base):
+    # running totals the achievement rules are evaluated against, see api.achievements
+    user_id = Column(Integer, ForeignKey('User.id'), unique=True)
+    labels = Column(Integer, default=0)
+    # labels on images that already had votes, and how many of those matched their majority
+    judged = Column(Integer, default=0)
+    agreed = Column(Integer, default=0)
+    # consecutive days with at least one label
+    streak = Column(Integer, default=0)
+    best_streak = Column(Integer, default=0)
+    last_day = Column(Date)
 
 
 class Label(Base):
@@ -58,15 +87,74 @@ class Labels(Base):
     image_id = Column(Integer, ForeignKey('Image.id'))
     label_id = Column(Integer, ForeignKey('Label.id'))
     user_id = Column(Integer, ForeignKey('User.id'))
+    client_event_id = Column(String, unique=True, index=True)
+    create_date = Column(DateTime)
 
     image = relationship('Image', uselist=False)
     user = relationship('User', uselist=False)
     label = relationship('Label', uselist=False)
 
+    __table_args__ = (Index('ix_Labels_image_id', 'image_id'),
+                      Index('ix_Labels_label_id_image_id', 'label_id', 'image_id'),
+                      Index('ix_Labels_user_id_image_id', 'user_id', 'image_id'))
+
+
+class Consensus(Base):
+    image_id = Column(Integer, ForeignKey('Image.id'), unique=True)
+    label_id = Column(Integer, ForeignKey('Label.id'))
+    votes = Column(Integer)
+    agreement = Column(Float)
+
+    # {label_id: n} and {label_id: sum of labeler weights}
+    counts = Column(JSON)
+    weights = Column(JSON)
+
+    image = relationship('Image', uselist=False)
+    label = relationship('Label', uselist=False)
+
+    __table_args__ = (Index('ix_Consensus_label_id', 'label_id'),)
+
+
+class Job(Base):
+    # one derived data stage of an ingested image, see api.ingest
+    image_id = Column(Integer, ForeignKey('Image.id'))
+    stage = Column(String)
+    status = Column(String)
+    attempts = Column(Integer, default=0)
+    error = Column(String)
+    batch_id = Column(String, index=True)
+    claimed_by = Column(String)
+
+    create_date = Column(DateTime, server_default=func.now())
+    available_at = Column(DateTime, server_default=func.now())
+    start_date = Column(DateTime)
+    finish_date = Column(DateTime)
+
+    __table_args__ = (Index('ix_Job_status_available_at', 'status', 'available_at'),
+                      Index('ix_Job_image_id_stage', 'image_id', 'stage', unique=True),
+                      Index('ix_Job_stage_finish_date', 'stage', 'finish_date'))
+
+
+class Change(Base):
+    # inserted Image and Labels rows in commit order, the id is the /changes cursor. see api.changes
+    kind = Column(String)
+    ref_id = Column(Integer)
+    create_date = Column(DateTime)
+
+
+class CacheVersion(Base):
+    # bumped when a cached reference table changes, see api.cache
+    name = Column(String, unique=True)
+    version = Column(Integer)
+
 
 class Image(Base):
     blob = Column(LargeBinary)
-    hashid = Column(String)
+    hashid = Column(String, index=True)
+    codec = Column(String)
+    original_size = Column(Integer)
+    # THUMBNAIL_SIZE**2 RGB pixels, uint8, row major. see storage.make_thumbnail
+    thumbnail = Column(LargeBinary)
 
     sample = Column(String)
     project = Column(String)
@@ -84,4 +172,11 @@ class Image(Base):
 
     create_date = Column(DateTime, server_default=func.now())
 
+    __table_args__ = (Index('ix_Image_loadname_trayname_id', 'loadname', 'trayname', 'id'),
+                      # trayname without a loadname, the index above can't serve it
+                      Index('ix_Image_trayname_id', 'trayname', 'id'),
+                      Index('ix_Image_sample_id', 'sample', 'id'),
+                      Index('ix_Image_material_id', 'material', 'id'),
+                      Index('ix_Image_create_date_id', 'create_date', 'id'))
+
 # ============= EOF =============================================
@@ -0,0 +1,220 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import io
+import math
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image as PILImage
+from sqlalchemy import func
+
+from api import cache
+from api.config import settings
+from api.models import Consensus, Image, Labels
+from api.session import SessionLocal, get_engine
+from api.storage import make_thumbnail, read_blob
+
+BORDER = 2
+BACKGROUND = (227, 204, 158)
+UNLABELED = (128, 128, 128)
+LABEL_COLORS = {'good': (40, 167, 69),
+                'empty': (23, 162, 184),
+                'multigrain': (255, 193, 7),
+                'contaminant': (220, 53, 69),
+                'bad': (108, 52, 131),
+                'blurry': (52, 58, 64)}
+
+_cache = OrderedDict()
+_lock = threading.Lock()
+
+
+def tray_version(db, loadname, trayname):
+    """
+    changes whenever an image is added to the tray, one of its images is labeled or the consensus
+    is recomputed (by any process)
+    """
+    q = db.query(func.max(Image.id), func.count(Labels.id), func.max(Labels.id))
+    q = q.outerjoin(Labels, Labels.image_id == Image.id)
+    v = q.filter(Image.loadname == loadname, Image.trayname == trayname).one()
+    return tuple(v) + (cache.version(db, Consensus.__tablename__),)
+
+
+def _thumbnails(rows, size):
+    """
+    thumbnails of the rows in order, missing ones (older images) are made and stored on the way.
+    stored with a session of its own, the request's session only reads
+    """
+    n = size * size * 3
+    out = np.empty((len(rows), size, size, 3), dtype=np.uint8)
+    missing = []
+    for i, r in enumerate(rows):
+        if r.thumbnail is not None and len(r.thumbnail) == n:
+            out[i] = np.frombuffer(r.thumbnail, dtype=np.uint8).reshape(size, size, 3)
+        else:
+            missing.append(i)
+
+    if missing:
+        ids = [rows[i].id for i in missing]
+        db = SessionLocal(bind=get_engine())
+        try:
+            images = {dbim.id: dbim for dbim in db.query(Image).filter(Image.id.in_(ids))}
+            for i in missing:
+                dbim = images[rows[i].id]
+                dbim.thumbnail = make_thumbnail(read_blob(dbim), size) or bytes(n)
+                out[i] = np.frombuffer(dbim.thumbnail, dtype=np.uint8).reshape(size, size, 3)
+            db.commit()
+        finally:
+            db.close()
+    return out
+
+
+def compose(thumbs, cells, cols, colors):
+    """
+    lay thumbnails out on a grid. thumbs (n, s, s, 3), cells (n,) grid index of every thumbnail,
+    colors (n, 3) border color. returns the (rows*c, cols*c, 3) mosaic, c = s + 2*BORDER
+    """
+    n, s = thumbs.shape[:2]
+    c = s + 2 * BORDER
+    rows = max(1, math.ceil((cells.max() + 1) / cols)) if n else 1
+
+    grid = np.empty((rows * cols, c, c, 3), dtype=np.uint8)
+    grid[:] = BACKGROUND
+    if n:
+        grid[cells] = colors[:, None, None, :]
+        grid[cells, BORDER:BORDER + s, BORDER:BORDER + s] = thumbs
+    return grid.reshape(rows, cols, c, c, 3).transpose(0, 2, 1, 3, 4).reshape(rows * c, cols * c, 3)
+
+
+def build(db, loadname, trayname, cols=None):
+    """
+    the mosaic png of a tray and a map of where every hole is. holes are placed row major by
+    hole_id, the newest image wins if a hole was imaged more than once
+    """
+    q = db.query(Image.id, Image.hole_id, Image.hashid, Image.thumbnail,
+                 Consensus.label_id, Consensus.votes, Consensus.agreement, Consensus.counts)
+    q = q.outerjoin(Consensus, Consensus.image_id == Image.id)
+    q = q.filter(Image.loadname == loadname, Image.trayname == trayname)
+    q = q.order_by(Image.hole_id, Image.id.desc())
+
+    rows = []
+    for r in q:
+        if rows and rows[-1].hole_id == r.hole_id:
+            continue
+        rows.append(r)
+
+    size = settings.THUMBNAIL_SIZE
+    thumbs = _thumbnails(rows, size)
+
+    hole_ids = np.array([r.hole_id or 0 for r in rows], dtype=np.int64)
+    cells = hole_ids - hole_ids.min() if len(rows) else hole_ids
+    if not cols:
+        cols = max(1, math.ceil(math.sqrt(cells.max() + 1))) if len(rows) else 1
+
+    label_ids = {r.label_id for r in rows if r.label_id is not None}
+    for r in rows:
+        label_ids.update(int(k) for k in (r.counts or {}))
+    names = cache.labels.names(db, label_ids)
+
+    colors = np.array([LABEL_COLORS.get(names.get(r.label_id), UNLABELED) if r.label_id else UNLABELED
+                       for r in rows], dtype=np.uint8).reshape(-1, 3)
+    arr = compose(thumbs, cells, cols, colors)
+
+    out = io.BytesIO()
+    PILImage.fromarray(arr).save(out, format='png', compress_level=1)
+
+    c = size + 2 * BORDER
+    holes = []
+    for r, cell in zip(rows, cells.tolist()):
+        holes.append({'hole_id': r.hole_id,
+                      'id': r.id,
+                      'hashid': r.hashid,
+                      'x': (cell % cols) * c,
+                      'y': (cell // cols) * c,
+                      'label': names.get(r.label_id),
+                      'votes': r.votes or 0,
+                      'agreement': r.agreement,
+                      'labels': {names.get(int(k)): v for k, v in (r.counts or {}).items()}})
+
+    obj = {'loadname': loadname,
+           'trayname': trayname,
+           'cell': c,
+           'thumbnail': size,
+           'cols': cols,
+           'width': arr.shape[1],
+           'height': arr.shape[0],
+           'holes': holes}
+    return out.getvalue(), obj
+
+
+def get_mosaic(db, loadname, trayname, cols=None):
+    """
+    cached build(). returns (version, png, map), rebuilt once the tray's labels change
+    """
+    key = (loadname, trayname, cols)
+    version = tray_version(db, loadname, trayname)
+    with _lock:
+        hit = _cache.get(key)
+        if hit and hit[0] == version:
+            _cache.move_to_end(key)
+            return hit
+
+    png, obj = build(db, loadname, trayname, cols)
+    obj['version'] = '-'.join(str(v or 0) for v in version)
+    hit = (version, png, obj)
+    with _lock:
+        _cache[key] = hit
+        while len(_cache) > settings.MOSAIC_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return hit
+
+
+def list_trays(db):
+    q = db.query(Image.loadname, Image.trayname, func.count(Image.id))
+    q = q.group_by(Image.loadname, Image.trayname).order_by(Image.loadname, Image.trayname)
+    return [{'loadname': l, 'trayname': t, 'count': n} for l, t, n in q]
+
+
+def backfill_thumbnails(db, batch=200):
+    """
+    make thumbnails for images stored before they existed. returns the number made
+    """
+    n = settings.THUMBNAIL_SIZE ** 2 * 3
+    total = 0
+    last = 0
+    while 1:
+        q = db.query(Image).filter(Image.id > last)
+        q = q.filter((Image.thumbnail == None) | (func.length(Image.thumbnail) != n))
+        rows = q.order_by(Image.id).limit(batch).all()
+        if not rows:
+            break
+
+        for dbim in rows:
+            last = dbim.id
+            dbim.thumbnail = make_thumbnail(read_blob(dbim)) or bytes(n)
+            total += 1
+        db.commit()
+        db.expunge_all()
+    return total
+
+
+if __name__ == '__main__':
+    from api.session import get_db
+
+    sess = next(get_db())
+    print('thumbnails made', backfill_thumbnails(sess))
+    sess.close()
+# ============= EOF =============================================
@@ -0,0 +1,59 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+from sqlalchemy import func
+
+from api import achievements, cache, consensus
+from api.models import Image, Labels
+
+
+def scoreboard_rows(db):
+    return achievements.scoreboard(db)
+
+
+def get_users_report(db, user):
+    q = db.query(Labels.label_id,
+                 func.count(Labels.label_id))
+
+    if user:
+        u = cache.users.get_one(db, user)
+        if u is None:
+            return []
+        q = q.filter(Labels.user_id == u.id)
+    records = q.group_by(Labels.label_id).all()
+    names = cache.labels.names(db, [l for l, c in records])
+    rows = [{'label': names[l], 'count': c} for l, c in records]
+    return rows
+
+
+def results_report(db):
+    rows = get_users_report(db, None)
+    total = db.query(Image).count()
+    classified = consensus.classified_count(db)
+
+    return {'table': rows,
+            'consensus': consensus.consensus_report(db),
+            'total': total,
+            'unclassified': total - classified}
+
+
+def version(db):
+    """
+    cheap change detector for the reports, both are primary key lookups
+    """
+    return (db.query(func.max(Labels.id)).scalar(),
+            db.query(func.max(Image.id)).scalar())
+
+# ============= EOF =============================================
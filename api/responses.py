@@ -0,0 +1,68 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import base64
+from datetime import date, datetime
+
+import msgpack
+import orjson
+from starlette.responses import Response
+
+MSGPACK = 'application/msgpack'
+
+
+def _json_default(obj):
+    # bytes fields are base64 in json, msgpack sends them raw
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        return base64.b64encode(obj).decode()
+    raise TypeError(f'{type(obj).__name__} is not JSON serializable')
+
+
+def _msgpack_default(obj):
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    if isinstance(obj, memoryview):
+        return obj.tobytes()
+    raise TypeError(f'{type(obj).__name__} is not msgpack serializable')
+
+
+class ORJSONResponse(Response):
+    media_type = 'application/json'
+
+    def render(self, content):
+        return orjson.dumps(content, default=_json_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+class MsgPackResponse(Response):
+    media_type = MSGPACK
+
+    def render(self, content):
+        return msgpack.packb(content, default=_msgpack_default, use_bin_type=True)
+
+
+def wants_msgpack(request):
+    return MSGPACK in request.headers.get('accept', '')
+
+
+def negotiate(request, content, status_code=200, headers=None):
+    """
+    msgpack for clients that send `Accept: application/msgpack`, json otherwise
+    """
+    headers = dict(headers or {})
+    headers['Vary'] = 'Accept'
+    cls = MsgPackResponse if wants_msgpack(request) else ORJSONResponse
+    return cls(content=content, status_code=status_code, headers=headers)
+
+# ============= EOF =============================================
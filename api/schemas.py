@@ -13,7 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # ===============================================================================
-from typing import Optional, Union
+from typing import List, Optional, Union
 
 from pydantic import BaseModel
 
@@ -34,6 +34,38 @@ class UnclassifiedImage(BaseModel):
     nxtals: Optional[int] = None
 
 
+class TrayHole(BaseModel):
+    hole_id: int
+    x: float
+    y: float
+
+
+class TrayImage(BaseModel):
+    trayname: str
+    image: str
+    zoom_level: Union[float, int]
+
+    template: Optional[str] = None
+    holes: Optional[List[TrayHole]] = None
+    radius: Optional[int] = None
+    margin: Optional[int] = None
+
+    loadname: Optional[str] = None
+    project: Optional[str] = None
+    sample: Optional[str] = None
+    material: Optional[str] = None
+    identifier: Optional[str] = None
+    note: Optional[str] = None
+
+
+class LabelEvent(BaseModel):
+    image_id: Optional[int] = None
+    hashid: Optional[str] = None
+    label: str
+    user: str = 'default'
+    client_event_id: Optional[str] = None
+
+
 class ORMBase(BaseModel):
     id: Optional[int] = None
 
@@ -13,27 +13,81 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # ===============================================================================
-from sqlalchemy import create_engine
+import os
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 
 from .config import settings
 
 SQLALCHEMY_DATABASE_URL = settings.DATABASE_URL
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
 
-# if you don't want to install postgres or any database, use sqlite, a file system based database,
-# uncomment below lines if you would like to use sqlite and comment above 2 lines of SQLALCHEMY_DATABASE_URL AND engine
+# applied to every sqlite connection. WAL lets readers run while a writer commits, NORMAL sync is
+# durable across application crashes in WAL mode
+SQLITE_PRAGMAS = ('journal_mode=WAL',
+                  'synchronous=NORMAL',
+                  'foreign_keys=ON',
+                  'busy_timeout=5000',
+                  'temp_store=MEMORY',
+                  'cache_size=-65536',
+                  'mmap_size=268435456')
+
+SessionLocal = sessionmaker(autocommit=False, autoflush=False)
+
+_engine = None
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for p in SQLITE_PRAGMAS:
+        cursor.execute(f'PRAGMA {p}')
+    cursor.close()
+
+
+def make_engine(url):
+    if make_url(url).get_backend_name() != 'sqlite':
+        return create_engine(url)
+
+    path = make_url(url).database
+    if path and path != ':memory:':
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    engine = create_engine(url, connect_args={'check_same_thread': False}, poolclass=QueuePool)
+    event.listen(engine, 'connect', _set_sqlite_pragmas)
+    return engine
+
+
+def get_engine():
+    """
+    the engine (and the DBAPI driver) is created on first use instead of at import so importing
+    the app does not pay for it
+    """
+    global _engine
+    if _engine is None:
+        _engine = make_engine(SQLALCHEMY_DATABASE_URL)
+    return _engine
+
+
+def pool_stats():
+    """
+    connection pool usage of this worker, empty until the first request opened the engine
+    """
+    if _engine is None:
+        return {}
 
-# SQLALCHEMY_DATABASE_URL = "sqlite:///./sql_app.db"
-# engine = create_engine(
-#     SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
-# )
-print(SQLALCHEMY_DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    pool = _engine.pool
+    stats = {'pool': type(pool).__name__}
+    for k in ('size', 'checkedin', 'checkedout', 'overflow'):
+        f = getattr(pool, k, None)
+        if f is not None:
+            stats[k] = f()
+    return stats
 
 
 def get_db():
-    db = SessionLocal()
+    db = SessionLocal(bind=get_engine())
     try:
         yield db
     finally:
@@ -0,0 +1,261 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import hashlib
+import io
+import os
+
+from sqlalchemy import func, or_
+
+from api.config import settings
+from api.models import Image
+
+# codec name -> (PIL format, save options)
+CODECS = {'raw': None,
+          'tiff_deflate': ('tiff', {'compression': 'tiff_adobe_deflate'}),
+          'tiff_lzw': ('tiff', {'compression': 'tiff_lzw'}),
+          'tiff_zstd': ('tiff', {'compression': 'zstd'}),
+          'png': ('png', {'compress_level': 6})}
+
+
+def media_type(codec):
+    return 'image/png' if codec == 'png' else 'image/tiff'
+
+
+def extension(codec):
+    return 'png' if codec == 'png' else 'tif'
+
+
+def encode(buf, codec=None):
+    """
+    transcode an uploaded image to a lossless compressed codec.
+    falls back to the original bytes ('raw') if the image cannot be re-encoded without losing
+    pixels (e.g. multi page tiffs or modes the target format does not support) or if
+    the encoded image is not smaller
+    """
+    codec = codec or settings.STORAGE_CODEC
+    if codec == 'raw':
+        return buf, 'raw'
+
+    from PIL import Image as PILImage
+
+    fmt, options = CODECS[codec]
+    try:
+        src = PILImage.open(io.BytesIO(buf))
+        if getattr(src, 'n_frames', 1) > 1:
+            return buf, 'raw'
+
+        src.load()
+        out = io.BytesIO()
+        src.save(out, format=fmt, **options)
+        encoded = out.getvalue()
+
+        dst = PILImage.open(io.BytesIO(encoded))
+        if dst.mode != src.mode or dst.size != src.size or dst.tobytes() != src.tobytes():
+            return buf, 'raw'
+    except (OSError, ValueError, KeyError) as e:
+        print('failed encoding image', codec, e)
+        return buf, 'raw'
+
+    if len(encoded) >= len(buf):
+        return buf, 'raw'
+    return encoded, codec
+
+
+def blob_path(hashid, codec):
+    return os.path.join(settings.BLOB_DIR, hashid[:2], f'{hashid}.{codec or "raw"}')
+
+
+def write_blob(hashid, codec, blob):
+    """
+    files are content addressed so an existing file is never rewritten. written to a temporary
+    name and renamed so readers never see a partial file
+    """
+    path = blob_path(hashid, codec)
+    if os.path.isfile(path):
+        return path
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as wfile:
+        wfile.write(blob)
+    os.replace(tmp, path)
+    return path
+
+
+def read_blob(dbim):
+    """
+    image bytes for an Image, or any row with blob, hashid and codec. rows written with
+    BLOB_STORE=disk have no blob in the database
+    """
+    if dbim.blob is not None:
+        return dbim.blob
+
+    with open(blob_path(dbim.hashid, dbim.codec), 'rb') as rfile:
+        return rfile.read()
+
+
+def make_thumbnail(buf, size=None):
+    """
+    raw RGB bytes of the image shrunk to fit a size x size square, centered on black. stored
+    uncompressed so a tray mosaic is a numpy reshape, not hundreds of decodes
+    """
+    from PIL import Image as PILImage
+
+    size = size or settings.THUMBNAIL_SIZE
+    try:
+        img = PILImage.open(io.BytesIO(buf))
+        img = img.convert('RGB')
+        img.thumbnail((size, size))
+    except (OSError, ValueError) as e:
+        print('failed making thumbnail', e)
+        return
+
+    canvas = PILImage.new('RGB', (size, size))
+    canvas.paste(img, ((size - img.width) // 2, (size - img.height) // 2))
+    return canvas.tobytes()
+
+
+def new_image(buf, hashid=None, derive=True, **kw):
+    """
+    make an Image for the uploaded bytes. hashid is always the hash of the bytes as received so
+    dedupe is independent of the storage codec.
+
+    derive=False stores the bytes as received without a thumbnail, the ingest worker does the rest
+    """
+    if hashid is None:
+        hashid = hashlib.sha256(buf).hexdigest()
+
+    blob, codec, thumbnail = buf, 'raw', None
+    if derive:
+        blob, codec = encode(buf)
+        thumbnail = make_thumbnail(buf)
+
+    if settings.BLOB_STORE == 'disk':
+        write_blob(hashid, codec, blob)
+        blob = None
+    return Image(blob=blob, hashid=hashid, codec=codec, original_size=len(buf),
+                 thumbnail=thumbnail, **kw)
+
+
+def recompress_image(dbim, codec=None):
+    """
+    transcode one raw image in place. returns the stored size before and after. the caller
+    commits and then calls remove_stale for images on disk
+    """
+    buf = read_blob(dbim)
+    before = len(buf)
+    blob, c = encode(buf, codec)
+    if dbim.original_size is None:
+        dbim.original_size = before
+    if c != 'raw':
+        if dbim.blob is None:
+            write_blob(dbim.hashid, c, blob)
+        else:
+            dbim.blob = blob
+    dbim.codec = c
+    return before, len(blob)
+
+
+def remove_stale(db, hashids):
+    """
+    delete raw blob files once no row refers to them anymore
+    """
+    for hashid in hashids:
+        q = db.query(Image.id).filter(Image.hashid == hashid, Image.blob == None)
+        if q.filter(or_(Image.codec == None, Image.codec == 'raw')).first() is None:
+            try:
+                os.remove(blob_path(hashid, 'raw'))
+            except FileNotFoundError:
+                pass
+
+
+def recompress(db, codec=None, batch=100):
+    """
+    transcode images that are still stored raw. returns a report of bytes saved
+    """
+    report = {'rows': 0, 'recompressed': 0, 'bytes_before': 0, 'bytes_after': 0}
+
+    last = 0
+    while 1:
+        q = db.query(Image).filter(Image.id > last)
+        q = q.filter(or_(Image.codec == None, Image.codec == 'raw'))
+        rows = q.order_by(Image.id).limit(batch).all()
+        if not rows:
+            break
+
+        stale = []
+        for dbim in rows:
+            last = dbim.id
+            before, after = recompress_image(dbim, codec)
+            if dbim.codec != 'raw':
+                if dbim.blob is None:
+                    stale.append(dbim.hashid)
+                report['recompressed'] += 1
+
+            report['rows'] += 1
+            report['bytes_before'] += before
+            report['bytes_after'] += after
+
+        db.commit()
+        db.expunge_all()
+        remove_stale(db, stale)
+
+    report['bytes_saved'] = report['bytes_before'] - report['bytes_after']
+    return report
+
+
+def storage_report(db):
+    codec = func.coalesce(Image.codec, 'raw')
+    stored = func.length(Image.blob)
+    q = db.query(codec,
+                 func.count(Image.id),
+                 func.sum(func.coalesce(Image.original_size, stored)),
+                 func.sum(stored))
+    on_disk = {}
+    for hashid, c in db.query(Image.hashid, codec).filter(Image.blob == None):
+        try:
+            on_disk[c] = on_disk.get(c, 0) + os.path.getsize(blob_path(hashid, c))
+        except OSError:
+            pass
+
+    rows = []
+    for c, n, original, stored in q.group_by(codec):
+        original = original or 0
+        stored = (stored or 0) + on_disk.get(c, 0)
+        rows.append({'codec': c,
+                     'count': n,
+                     'original_bytes': original,
+                     'stored_bytes': stored,
+                     'saved_bytes': original - stored})
+    return rows
+
+
+if __name__ == '__main__':
+    import argparse
+    import pprint
+    from api.session import get_db
+
+    parser = argparse.ArgumentParser(description='Image storage maintenance')
+    parser.add_argument('command', choices=('recompress', 'report'))
+    parser.add_argument('--codec', choices=tuple(CODECS))
+    args = parser.parse_args()
+
+    sess = next(get_db())
+    if args.command == 'recompress':
+        pprint.pprint(recompress(sess, args.codec))
+    pprint.pprint(storage_report(sess))
+    sess.close()
+# ============= EOF =============================================
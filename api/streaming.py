@@ -0,0 +1,185 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import asyncio
+import os
+
+from sqlalchemy import func
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response, StreamingResponse
+
+from api.config import settings
+from api.models import Image
+from api.session import SessionLocal, get_engine
+from api.storage import blob_path, media_type
+
+
+class ByteBudget:
+    """
+    caps the image bytes a worker holds in memory at once. every chunk is reserved before it is
+    read and released once the server asked for the next one, i.e. after it was handed to the
+    client connection. streams wait for room instead of growing memory
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self._cond = None
+
+    def _condition(self):
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    async def acquire(self, n):
+        n = min(n, self.limit)
+        cond = self._condition()
+        async with cond:
+            await cond.wait_for(lambda: self.used + n <= self.limit)
+            self.used += n
+        return n
+
+    async def release(self, n):
+        cond = self._condition()
+        async with cond:
+            self.used -= n
+            cond.notify_all()
+
+
+budget = ByteBudget(settings.IMAGE_INFLIGHT_BYTES)
+
+
+def parse_range(header, size):
+    """
+    single `bytes=` range -> inclusive (start, end). None means send the whole image, which is
+    also what a malformed or multi range header gets. raises ValueError if the range cannot be
+    satisfied
+    """
+    if not header or not header.startswith('bytes='):
+        return
+
+    spec = header[6:].strip()
+    if ',' in spec:
+        return
+
+    first, sep, last = spec.partition('-')
+    if not sep or not (first or last) or not all(p.isdigit() for p in (first, last) if p):
+        return
+
+    if first:
+        start = int(first)
+        end = size - 1
+        if last:
+            if int(last) < start:
+                return
+            end = min(int(last), size - 1)
+    else:
+        n = int(last)
+        if not n:
+            raise ValueError(f'{header} not satisfiable')
+        start, end = max(0, size - n), size - 1
+
+    if start >= size:
+        raise ValueError(f'{header} not satisfiable for {size} bytes')
+    return start, end
+
+
+def image_row(db, hashid=None):
+    """
+    what is needed to serve an image without reading its bytes
+    """
+    q = db.query(Image.id, Image.hashid, Image.codec, func.length(Image.blob).label('size'))
+    if hashid:
+        q = q.filter(Image.hashid == hashid)
+    return q.first()
+
+
+def _read_db(image_id, offset, n):
+    # a short lived session per chunk, a slow client must not hold a pooled connection
+    db = SessionLocal(bind=get_engine())
+    try:
+        data = db.query(func.substr(Image.blob, offset + 1, n)).filter(Image.id == image_id).scalar()
+    finally:
+        db.close()
+    return bytes(data) if data is not None else b''
+
+
+def _open(path, offset):
+    f = open(path, 'rb')
+    f.seek(offset)
+    return f
+
+
+async def iter_image(row, start, end, path=None, chunk=None):
+    chunk = chunk or settings.IMAGE_CHUNK_SIZE
+    f = await run_in_threadpool(_open, path, start) if path else None
+    try:
+        pos = start
+        while pos <= end:
+            n = await budget.acquire(min(chunk, end - pos + 1))
+            try:
+                if f is not None:
+                    data = await run_in_threadpool(f.read, n)
+                else:
+                    data = await run_in_threadpool(_read_db, row.id, pos, n)
+                if not data:
+                    break
+                pos += len(data)
+                yield data
+            finally:
+                await budget.release(n)
+    finally:
+        if f is not None:
+            f.close()
+
+
+def image_response(request, row):
+    """
+    stream an image in IMAGE_CHUNK_SIZE pieces, from the blob store file or with substr() on the
+    database column, honoring Range, If-Range and If-None-Match
+    """
+    path = None
+    size = row.size
+    if size is None:
+        path = blob_path(row.hashid, row.codec)
+        size = os.path.getsize(path)
+
+    etag = f'"{row.hashid}.{row.codec or "raw"}"'
+    headers = {'Accept-Ranges': 'bytes', 'ETag': etag}
+    if request.headers.get('if-none-match') == etag:
+        return Response(status_code=304, headers=headers)
+
+    header = request.headers.get('range')
+    if header and request.headers.get('if-range', etag) != etag:
+        header = None
+
+    try:
+        r = parse_range(header, size)
+    except ValueError:
+        headers['Content-Range'] = f'bytes */{size}'
+        return Response(status_code=416, headers=headers)
+
+    status = 200
+    start, end = 0, size - 1
+    if r is not None:
+        status = 206
+        start, end = r
+        headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+
+    headers['Content-Length'] = str(end - start + 1)
+    return StreamingResponse(iter_image(row, start, end, path), status_code=status,
+                             media_type=media_type(row.codec), headers=headers)
+
+# ============= EOF =============================================
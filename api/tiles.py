@@ -0,0 +1,315 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+"""
+deep zoom (DZI) tile pyramids so a viewer only downloads the tiles it shows.
+
+level max is the full resolution image, every level below is half the size of the one above,
+level 0 is 1x1. the descriptor only needs the image size, read from the image header, so
+opening an image is cheap. each tile is rendered the first time it is asked for and kept in
+TILE_DIR/<hashid[:2]>/<hashid>/<level>/<col>_<row>.<format>. files are written to a temp name
+and renamed into place, a tile that exists is complete
+"""
+import io
+import json
+import math
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+from api.config import settings
+from api.models import Image
+from api.storage import read_blob
+
+DZI_NS = 'http://schemas.microsoft.com/deepzoom/2008'
+MEDIA_TYPES = {'png': 'image/png', 'jpeg': 'image/jpeg'}
+
+_locks = {}
+_lock = threading.Lock()
+
+# decoded full resolution images, the tiles of an image are asked for in bursts
+_sources = OrderedDict()
+
+
+def pyramid_dir(hashid):
+    return os.path.join(settings.TILE_DIR, hashid[:2], hashid)
+
+
+def tile_path(hashid, level, col, row, fmt):
+    return os.path.join(pyramid_dir(hashid), str(level), f'{col}_{row}.{fmt}')
+
+
+def max_level(width, height):
+    return math.ceil(math.log2(max(width, height, 1)))
+
+
+def level_size(width, height, level):
+    scale = 2 ** (max_level(width, height) - level)
+    return math.ceil(width / scale), math.ceil(height / scale)
+
+
+def tile_box(col, row, width, height, size, overlap):
+    """
+    pixel box of a tile, tiles share `overlap` pixels with each neighbour
+    """
+    x, y = col * size, row * size
+    return (max(x - overlap, 0), max(y - overlap, 0),
+            min(x + size + overlap, width), min(y + size + overlap, height))
+
+
+def _open(buf):
+    from PIL import Image as PILImage
+
+    return PILImage.open(io.BytesIO(buf))
+
+
+def _prepare(buf):
+    img = _open(buf)
+    img.load()
+    if img.mode not in ('L', 'RGB'):
+        img = img.convert('RGB')
+    return img
+
+
+def _save(img, path, fmt):
+    if fmt == 'jpeg':
+        img.save(path, format='jpeg', quality=settings.TILE_QUALITY)
+    else:
+        img.save(path, format='png', compress_level=1)
+
+
+def _write(path, dump):
+    """
+    write a file under a temp name and rename it into place
+    """
+    d = os.path.dirname(path)
+    os.makedirs(d, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=d, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as wfile:
+            dump(wfile)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def _key_lock(hashid):
+    with _lock:
+        return _locks.setdefault(hashid, threading.Lock())
+
+
+def _release(hashid, lock):
+    # only while holding the lock, a thread still waiting on it re-checks what it waited for
+    with _lock:
+        if _locks.get(hashid) is lock:
+            del _locks[hashid]
+
+
+def _read(db, hashid):
+    dbim = db.query(Image.hashid, Image.codec, Image.blob).filter(Image.hashid == hashid).first()
+    if dbim is None:
+        return
+    try:
+        return read_blob(dbim)
+    except FileNotFoundError:
+        return
+
+
+def render_tile(img, obj, level, col, row):
+    """
+    one tile cut from the full resolution image. the source box is reduced by the level's scale
+    in one step, its origin is a multiple of the scale so neighbouring tiles line up
+    """
+    scale = 2 ** (obj['max_level'] - level)
+    w, h = level_size(obj['width'], obj['height'], level)
+    x0, y0, x1, y1 = tile_box(col, row, w, h, obj['tile_size'], obj['overlap'])
+    tile = img.crop((x0 * scale, y0 * scale, min(x1 * scale, obj['width']), min(y1 * scale, obj['height'])))
+    return tile.reduce(scale) if scale > 1 else tile
+
+
+def get_pyramid(db, hashid):
+    """
+    descriptor of the image's pyramid, made from the image size on first use. None if there is
+    no such image. raises ValueError if the image cannot be read
+    """
+    path = os.path.join(pyramid_dir(hashid), 'pyramid.json')
+    if not os.path.isfile(path):
+        lock = _key_lock(hashid)
+        with lock:
+            try:
+                if not os.path.isfile(path):
+                    buf = _read(db, hashid)
+                    if buf is None:
+                        return
+
+                    try:
+                        width, height = _open(buf).size
+                    except (OSError, ValueError) as e:
+                        raise ValueError(f'cannot tile {hashid}: {e}')
+
+                    obj = {'width': width, 'height': height, 'tile_size': settings.TILE_SIZE,
+                           'overlap': settings.TILE_OVERLAP, 'format': settings.TILE_FORMAT,
+                           'max_level': max_level(width, height)}
+                    _write(path, lambda wfile: wfile.write(json.dumps(obj).encode()))
+                    return obj
+            finally:
+                _release(hashid, lock)
+
+    # last use, for prune()
+    os.utime(path)
+    with open(path, 'r') as rfile:
+        return json.load(rfile)
+
+
+def _source(db, hashid):
+    """
+    the decoded image, one decode per image however many of its tiles are asked for at once
+    """
+    with _lock:
+        img = _sources.get(hashid)
+        if img is not None:
+            _sources.move_to_end(hashid)
+            return img
+
+    lock = _key_lock(hashid)
+    with lock:
+        try:
+            with _lock:
+                img = _sources.get(hashid)
+            if img is None:
+                buf = _read(db, hashid)
+                if buf is None:
+                    return
+                try:
+                    img = _prepare(buf)
+                except (OSError, ValueError) as e:
+                    raise ValueError(f'cannot tile {hashid}: {e}')
+
+                with _lock:
+                    _sources[hashid] = img
+                    while len(_sources) > settings.TILE_SOURCE_CACHE:
+                        _sources.popitem(last=False)
+            return img
+        finally:
+            _release(hashid, lock)
+
+
+def descriptor(obj, url=''):
+    """
+    the DZI descriptor in the json form OpenSeadragon takes as a tile source. tiles are found at
+    <url><level>/<col>_<row>.<format>
+    """
+    return {'Image': {'xmlns': DZI_NS,
+                      'Url': url,
+                      'Format': obj['format'],
+                      'Overlap': str(obj['overlap']),
+                      'TileSize': str(obj['tile_size']),
+                      'Size': {'Width': str(obj['width']),
+                               'Height': str(obj['height'])}}}
+
+
+def descriptor_xml(obj):
+    return (f'<?xml version="1.0" encoding="UTF-8"?>\n'
+            f'<Image xmlns="{DZI_NS}" Format="{obj["format"]}" Overlap="{obj["overlap"]}" '
+            f'TileSize="{obj["tile_size"]}">'
+            f'<Size Width="{obj["width"]}" Height="{obj["height"]}"/></Image>')
+
+
+def get_tile(db, hashid, level, col, row, fmt, obj=None):
+    """
+    path of one tile, rendered on first use. None if the image or the tile does not exist. obj is
+    the descriptor from get_pyramid if the caller already has it
+    """
+    if obj is None:
+        obj = get_pyramid(db, hashid)
+    if obj is None or fmt != obj['format'] or not 0 <= level <= obj['max_level']:
+        return
+
+    w, h = level_size(obj['width'], obj['height'], level)
+    size = obj['tile_size']
+    if not (0 <= col < math.ceil(w / size) and 0 <= row < math.ceil(h / size)):
+        return
+
+    path = tile_path(hashid, level, col, row, fmt)
+    if not os.path.isfile(path):
+        img = _source(db, hashid)
+        if img is None:
+            return
+        tile = render_tile(img, obj, level, col, row)
+        # two requests may render the same tile, the rename makes either result the file
+        _write(path, lambda wfile: _save(tile, wfile, fmt))
+    return path
+
+
+def build(db, hashid):
+    """
+    render every tile of an image ahead of time. returns the number of tiles, None if there is no
+    such image
+    """
+    obj = get_pyramid(db, hashid)
+    if obj is None:
+        return
+
+    n = 0
+    size = obj['tile_size']
+    for level in range(obj['max_level'] + 1):
+        w, h = level_size(obj['width'], obj['height'], level)
+        for col in range(math.ceil(w / size)):
+            for row in range(math.ceil(h / size)):
+                n += get_tile(db, hashid, level, col, row, obj['format'], obj) is not None
+    return n
+
+
+def prune(keep):
+    """
+    delete all but the `keep` most recently used pyramids. returns the number deleted
+    """
+    roots = []
+    for d in os.scandir(settings.TILE_DIR) if os.path.isdir(settings.TILE_DIR) else ():
+        if not d.is_dir():
+            continue
+        for p in os.scandir(d.path):
+            path = os.path.join(p.path, 'pyramid.json')
+            if p.is_dir() and os.path.isfile(path):
+                roots.append((os.path.getmtime(path), p.path))
+
+    roots.sort(reverse=True)
+    for _, root in roots[keep:]:
+        shutil.rmtree(root, ignore_errors=True)
+    return max(len(roots) - keep, 0)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from api.session import get_db
+
+    parser = argparse.ArgumentParser(description='Build or prune deep zoom tile pyramids')
+    parser.add_argument('hashids', nargs='*', help='render every tile of these images')
+    parser.add_argument('--prune', type=int, metavar='KEEP',
+                        help='keep only the KEEP most recently viewed pyramids')
+    args = parser.parse_args()
+
+    sess = next(get_db())
+    for h in args.hashids:
+        print(h, build(sess, h))
+    sess.close()
+
+    if args.prune is not None:
+        print('pyramids deleted', prune(args.prune))
+# ============= EOF =============================================
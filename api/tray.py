@@ -0,0 +1,127 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import hashlib
+import io
+import json
+import os
+
+import numpy as np
+from PIL import Image as PILImage
+
+from api import changes
+from api.config import settings
+from api.models import Image
+from api.storage import new_image
+
+
+def load_template(name):
+    """
+    tray templates are json files in TRAY_TEMPLATE_DIR named <trayname>.json
+
+    {"radius": 200, "holes": [[hole_id, x, y], ...]}
+
+    x, y are the hole centers in pixels of the full tray image, see trays/example.json
+    """
+    p = os.path.join(settings.TRAY_TEMPLATE_DIR, f'{os.path.basename(name)}.json')
+    if not os.path.isfile(p):
+        return
+
+    with open(p, 'r') as rfile:
+        obj = json.load(rfile)
+    return obj['holes'], obj['radius']
+
+
+def in_bounds(shape, centers, radius, margin):
+    """
+    mask of the centers whose whole window lies inside an image of `shape`
+    """
+    h, w = shape[:2]
+    centers = np.rint(np.asarray(centers, dtype=float)).astype(int).reshape(-1, 2)
+    r = radius - margin
+    return ((centers[:, 0] - r >= 0) & (centers[:, 0] + r <= w) &
+            (centers[:, 1] - r >= 0) & (centers[:, 1] + r <= h))
+
+
+def slice_holes(arr, centers, radius, margin):
+    """
+    cut a (2*(radius-margin))**2 window around every center with a single fancy index.
+    the windows must be in_bounds, the indices are only clipped so a bad center cannot wrap around
+    """
+    h, w = arr.shape[:2]
+    centers = np.rint(np.asarray(centers, dtype=float)).astype(int)
+    offsets = np.arange(-radius + margin, radius - margin)
+
+    ys = np.clip(centers[:, 1, None] + offsets, 0, h - 1)
+    xs = np.clip(centers[:, 0, None] + offsets, 0, w - 1)
+    return arr[ys[:, :, None], xs[:, None, :]]
+
+
+def decode(buf):
+    img = PILImage.open(io.BytesIO(buf))
+    if img.mode in ('P', 'CMYK', 'YCbCr'):
+        img = img.convert('RGB')
+    return np.asarray(img)
+
+
+def add_tray(db, buf, holes, radius, margin=None, derive=True, **kw):
+    """
+    slice a full tray image into holes and add every new hole to the session. flushes, the caller
+    commits so it can add its own rows (e.g. ingest jobs) to the same transaction.
+
+    holes: sequence of (hole_id, x, y). holes that run off the edge of the tray image are not
+    stored, their pixels would be made up.
+    returns a list of (hole_id, image, created) and the list of skipped hole_ids. image is the
+    new Image or the (id, hashid) of the one already stored
+    """
+    if margin is None:
+        margin = settings.CROP_MARGIN
+    if radius <= margin:
+        raise ValueError(f'radius={radius} must be larger than the crop margin={margin}')
+
+    holes = np.asarray(holes, dtype=float).reshape(-1, 3)
+    arr = decode(buf)
+    mask = in_bounds(arr.shape, holes[:, 1:], radius, margin)
+    skipped = holes[~mask, 0].astype(int).tolist()
+    holes = holes[mask]
+
+    hole_ids = holes[:, 0].astype(int).tolist()
+    patches = slice_holes(arr, holes[:, 1:], radius, margin) if len(holes) else ()
+
+    bufs = []
+    for patch in patches:
+        bb = io.BytesIO()
+        PILImage.fromarray(patch).save(bb, format='tiff')
+        b = bb.getvalue()
+        bufs.append((hashlib.sha256(b).hexdigest(), b))
+
+    hashes = [ha for ha, _ in bufs]
+    existing = {r.hashid: r for r in db.query(Image.id, Image.hashid).filter(Image.hashid.in_(hashes))}
+
+    rows = []
+    for hole_id, (ha, b) in zip(hole_ids, bufs):
+        dbim = existing.get(ha)
+        created = dbim is None
+        if created:
+            dbim = new_image(b, hashid=ha, hole_id=hole_id, derive=derive, **kw)
+            db.add(dbim)
+            existing[ha] = dbim
+        rows.append((hole_id, dbim, created))
+
+    db.flush()
+    changes.record(db, 'image', [dbim.id for _, dbim, c in rows if c])
+    return rows, skipped
+
+# ============= EOF =============================================
@@ -0,0 +1,107 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import multiprocessing
+import os
+import socket
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from api import ingest
+from api.config import settings
+from api.session import get_db
+
+
+def run_job(image_id, stage):
+    """
+    runs in a pool process with its own engine
+    """
+    db = next(get_db())
+    try:
+        ingest.run_stage(db, image_id, stage)
+    finally:
+        db.close()
+
+
+def worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def work(processes=None, once=False):
+    """
+    keep the process pool busy with claimed jobs. the main process only does the bookkeeping,
+    the stages run in the pool. returns the number of jobs finished
+    """
+    processes = processes or settings.INGEST_WORKERS
+    name = worker_name()
+    db = next(get_db())
+    print(f'ingest worker {name} processes={processes}')
+
+    ingest.requeue_stale(db, name)
+    last_requeue = time.time()
+
+    # spawn, a forked child would inherit the parent's database connections
+    ctx = multiprocessing.get_context('spawn')
+    finished = 0
+    with ProcessPoolExecutor(processes, mp_context=ctx) as pool:
+        running = {}
+        while 1:
+            free = processes * 2 - len(running)
+            if free > 0:
+                for job_id, image_id, stage, attempts in ingest.claim(db, free, name):
+                    running[pool.submit(run_job, image_id, stage)] = job_id
+
+            if not running:
+                if once:
+                    break
+                if time.time() - last_requeue > settings.INGEST_JOB_TIMEOUT:
+                    ingest.requeue_stale(db)
+                    last_requeue = time.time()
+                time.sleep(settings.INGEST_POLL)
+                continue
+
+            done, _ = wait(running, timeout=settings.INGEST_POLL, return_when=FIRST_COMPLETED)
+            for fut in done:
+                job_id = running.pop(fut)
+                try:
+                    fut.result()
+                except Exception as e:
+                    print(f'job {job_id} failed', ''.join(traceback.format_exception_only(type(e), e)).strip())
+                    ingest.fail(db, job_id, e)
+                else:
+                    ingest.complete(db, job_id)
+                finished += 1
+
+    db.close()
+    return finished
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run the ingest job stages')
+    parser.add_argument('--processes', type=int)
+    parser.add_argument('--once', action='store_true', help='exit when the queue is empty')
+    parser.add_argument('--retry-failed', action='store_true', help='requeue failed jobs first')
+    args = parser.parse_args()
+
+    if args.retry_failed:
+        sess = next(get_db())
+        print('requeued', ingest.retry_failed(sess))
+        sess.close()
+
+    print('jobs finished', work(args.processes, args.once))
+# ============= EOF =============================================
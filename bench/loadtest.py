@@ -0,0 +1,559 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+"""
+concurrent labeler load test
+
+    python bench/loadtest.py --start [--users 1,2,4,8,16,32] [--duration 20] [--out curve.json]
+    python bench/loadtest.py --api http://localhost:8000 --users 8,16
+    python bench/loadtest.py --target frontend --frontend http://localhost:8051 --api http://localhost:8000
+    python bench/loadtest.py --compare old.json new.json
+
+every simulated labeler runs the click flow of frontend handle_image in a loop with an
+exponential think time between clicks. target api issues the API requests a click makes (label,
+reports, next image info, examples, users, and the deep zoom descriptor and tiles the viewer
+loads at home zoom); target frontend posts the handle_image callback to the Dash server, which
+then talks to the API itself.
+
+for each number of labelers the run reports clicks/s, requests/s, p50/p95/p99 latency of a click
+and of every endpoint, the error rate and the DB connection pool usage sampled from /health
+(per API worker). the steps are written as a json saturation curve, --compare prints two
+curves side by side.
+
+--start launches uvicorn (and the Dash app for --target frontend) on a throwaway sqlite
+database seeded with --images images, see bench/startup.py for the environment
+"""
+import argparse
+import asyncio
+import glob
+import json
+import math
+import os
+import random
+import struct
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime
+
+from startup import ROOT, bench_env, free_port
+
+LABELS = ('good', 'empty', 'multigrain', 'contaminant')
+BUTTONS = ('good_btn', 'skip_btn', 'empty_btn', 'multigrain_btn', 'contaminant_btn')
+MSGPACK = {'Accept': 'application/msgpack'}
+# size of the deep zoom viewer in the Classify tab, it shows the whole image at home zoom
+VIEWER_SIZE = 800
+
+
+def home_tiles(source, viewer=VIEWER_SIZE):
+    """
+    the tiles of the level OpenSeadragon shows when the whole image fits the viewer
+    """
+    img = source['Image']
+    width, height = int(img['Size']['Width']), int(img['Size']['Height'])
+    size = int(img['TileSize'])
+    top = math.ceil(math.log2(max(width, height, 1)))
+    level = top - max(0, math.ceil(math.log2(max(width, height) / viewer)))
+    scale = 2 ** (top - level)
+    w, h = math.ceil(width / scale), math.ceil(height / scale)
+    return [(level, col, row, img['Format'])
+            for col in range(math.ceil(w / size)) for row in range(math.ceil(h / size))]
+
+
+# ---------------------------------------------------------------------------- http
+class Connection:
+    """
+    minimal keep-alive HTTP/1.1 client, one per simulated labeler like a browser tab
+    """
+
+    def __init__(self, url, timeout):
+        u = urllib.parse.urlsplit(url)
+        self.host = u.hostname
+        self.port = u.port or 80
+        self.timeout = timeout
+        self.reader = self.writer = None
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+        self.reader = self.writer = None
+
+    async def request(self, method, path, body=None, headers=None):
+        fresh = self.writer is None
+        try:
+            return await asyncio.wait_for(self._request(method, path, body, headers), self.timeout)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            await self.close()
+            if fresh:
+                raise
+            # the server closed an idle keep-alive connection, retry once on a new one
+            return await asyncio.wait_for(self._request(method, path, body, headers), self.timeout)
+        except BaseException:
+            await self.close()
+            raise
+
+    async def _request(self, method, path, body, headers):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+        lines = [f'{method} {path} HTTP/1.1', f'Host: {self.host}:{self.port}']
+        for k, v in (headers or {}).items():
+            lines.append(f'{k}: {v}')
+        body = body or b''
+        if body or method == 'POST':
+            lines.append(f'Content-Length: {len(body)}')
+        self.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode() + body)
+        await self.writer.drain()
+
+        status_line = await self.reader.readuntil(b'\r\n')
+        status = int(status_line.split()[1])
+        rheaders = {}
+        while 1:
+            line = await self.reader.readuntil(b'\r\n')
+            if line == b'\r\n':
+                break
+            k, v = line.decode('latin-1').split(':', 1)
+            rheaders[k.strip().lower()] = v.strip()
+
+        if rheaders.get('transfer-encoding') == 'chunked':
+            chunks = []
+            while 1:
+                size = int((await self.reader.readuntil(b'\r\n')).split(b';')[0], 16)
+                chunk = await self.reader.readexactly(size + 2)
+                if not size:
+                    break
+                chunks.append(chunk[:-2])
+            content = b''.join(chunks)
+        elif 'content-length' in rheaders:
+            content = await self.reader.readexactly(int(rheaders['content-length']))
+        elif status in (204, 304):
+            content = b''
+        else:
+            content = await self.reader.read()
+            rheaders['connection'] = 'close'
+
+        if rheaders.get('connection') == 'close':
+            await self.close()
+        return status, rheaders, content
+
+
+# ---------------------------------------------------------------------------- stats
+def percentile(values, q):
+    if not values:
+        return None
+    idx = min(len(values) - 1, max(0, int(round(q / 100 * (len(values) - 1)))))
+    return values[idx]
+
+
+def summarize(latencies):
+    latencies = sorted(latencies)
+    return {'count': len(latencies),
+            'p50_ms': _ms(percentile(latencies, 50)),
+            'p95_ms': _ms(percentile(latencies, 95)),
+            'p99_ms': _ms(percentile(latencies, 99)),
+            'max_ms': _ms(latencies[-1] if latencies else None)}
+
+
+def _ms(v):
+    return None if v is None else round(v * 1000, 2)
+
+
+class Stats:
+    def __init__(self):
+        self.recording = False
+        self.clicks = []
+        self.requests = {}
+        self.errors = {}
+        self.pool = []
+
+    def request(self, name, dt, ok):
+        if not self.recording:
+            return
+        self.requests.setdefault(name, []).append(dt)
+        if not ok:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+    def click(self, dt):
+        if self.recording:
+            self.clicks.append(dt)
+
+    def report(self, users, elapsed):
+        n = sum(len(v) for v in self.requests.values())
+        errors = sum(self.errors.values())
+        checkedout = [p.get('checkedout', 0) for p in self.pool]
+        return {'users': users,
+                'seconds': round(elapsed, 2),
+                'clicks': len(self.clicks),
+                'clicks_per_s': round(len(self.clicks) / elapsed, 2),
+                'requests_per_s': round(n / elapsed, 2),
+                'error_rate': round(errors / n, 4) if n else 0,
+                'errors': dict(self.errors),
+                'click': summarize(self.clicks),
+                'endpoints': {k: summarize(v) for k, v in sorted(self.requests.items())},
+                'db_pool': {'samples': len(self.pool),
+                            'size': max((p.get('size', 0) for p in self.pool), default=None),
+                            'checkedout_max': max(checkedout, default=None),
+                            'checkedout_mean': round(sum(checkedout) / len(checkedout), 2)
+                            if checkedout else None,
+                            'overflow_max': max((p.get('overflow', 0) for p in self.pool), default=None)}}
+
+
+# ---------------------------------------------------------------------------- labelers
+class Labeler:
+    def __init__(self, idx, args, stats):
+        self.name = f'load{idx}'
+        self.args = args
+        self.stats = stats
+        self.rng = random.Random(args.seed + idx)
+        self.image_id = None
+        self.cursor = None
+        self.api = Connection(args.api, args.timeout)
+        self.frontend = Connection(args.frontend, args.timeout) if args.target == 'frontend' else None
+
+    async def call(self, conn, name, method, path, body=None, headers=None):
+        st = time.perf_counter()
+        ok = False
+        try:
+            status, rheaders, content = await conn.request(method, path, body, headers)
+            ok = status < 400
+            return status, rheaders, content
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError):
+            return None, {}, b''
+        finally:
+            self.stats.request(name, time.perf_counter() - st, ok)
+
+    async def run(self):
+        await asyncio.sleep(self.rng.uniform(0, self.args.think))
+        try:
+            while 1:
+                st = time.perf_counter()
+                if self.frontend is not None:
+                    await self.click_frontend()
+                else:
+                    await self.click_api()
+                self.stats.click(time.perf_counter() - st)
+                await asyncio.sleep(self.rng.expovariate(1 / self.args.think) if self.args.think else 0)
+        finally:
+            await self.api.close()
+            if self.frontend is not None:
+                await self.frontend.close()
+
+    async def click_api(self):
+        """
+        the requests handle_image makes for one button press
+        """
+        if self.image_id:
+            label = self.rng.choice(LABELS)
+            await self.call(self.api, 'label', 'POST', f'/label/{self.image_id}?label={label}&user={self.name}')
+
+        if self.args.reports:
+            await self.call(self.api, 'results_report', 'GET', '/results_report', headers=MSGPACK)
+            await self.call(self.api, 'scoreboard', 'GET', f'/scoreboard?user={self.name}', headers=MSGPACK)
+
+        path = '/unclassified_image_info'
+        if self.cursor:
+            path = f'{path}?image_id={self.cursor}'
+        status, _, content = await self.call(self.api, 'unclassified_image_info', 'GET', path)
+        obj = json.loads(content) if status == 200 and content else None
+        if obj:
+            self.image_id = self.cursor = obj['id']
+            await self.view(obj['hashid'])
+        else:
+            # ran off the end of the images, start over at the first one
+            self.image_id = None
+            self.cursor = -1
+
+        await self.call(self.api, 'representative_images', 'GET', '/representative_images', headers=MSGPACK)
+        await self.call(self.api, 'users', 'GET', '/users')
+
+    async def view(self, hashid):
+        """
+        what the deep zoom viewer loads for the next image, the descriptor then the visible tiles
+        """
+        status, _, content = await self.call(self.api, 'tile_source', 'GET', f'/tiles/{hashid}.json')
+        if status != 200 or not content:
+            return
+        for level, col, row, fmt in home_tiles(json.loads(content)):
+            await self.call(self.api, 'tile', 'GET', f'/tiles/{hashid}_files/{level}/{col}_{row}.{fmt}')
+
+    async def click_frontend(self):
+        """
+        post the handle_image callback the browser would send
+        """
+        button = self.rng.choice(BUTTONS) if self.image_id else 'skip_btn'
+        body = json.dumps(dash_payload(button, self.image_id, self.name)).encode()
+        status, _, content = await self.call(self.frontend, 'dash:handle_image', 'POST',
+                                             '/_dash-update-component', body,
+                                             {'Content-Type': 'application/json'})
+        if status == 200 and content:
+            try:
+                self.image_id = json.loads(content)['response']['image_id']['children'] or None
+            except (KeyError, ValueError, TypeError):
+                pass
+
+
+HANDLE_IMAGE_OUTPUTS = (('deepzoom_source', 'data'), ('image_id', 'children'), ('good_graph', 'children'),
+                        ('empty_graph', 'children'), ('multigrain_graph', 'children'),
+                        ('contaminant_graph', 'children'), ('image_table', 'data'),
+                        ('confirm-danger', 'displayed'), ('label_guess', 'children'),
+                        ('available_users', 'children'))
+
+
+def dash_payload(button, image_id, username):
+    return {'output': '..' + '...'.join(f'{i}.{p}' for i, p in HANDLE_IMAGE_OUTPUTS) + '..',
+            'outputs': [{'id': i, 'property': p} for i, p in HANDLE_IMAGE_OUTPUTS],
+            'inputs': [{'id': b, 'property': 'n_clicks', 'value': 1 if b == button else None}
+                       for b in BUTTONS],
+            'changedPropIds': [f'{button}.n_clicks'],
+            'state': [{'id': 'image_id', 'property': 'children', 'value': image_id},
+                      {'id': 'username', 'property': 'value', 'value': username},
+                      {'id': 'image_table', 'property': 'data', 'value': None}]}
+
+
+async def sample_pool(args, stats):
+    conn = Connection(args.api, args.timeout)
+    try:
+        while 1:
+            try:
+                status, _, content = await conn.request('GET', '/health')
+                if status == 200 and stats.recording:
+                    stats.pool.append(json.loads(content).get('db_pool') or {})
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError):
+                pass
+            await asyncio.sleep(args.pool_interval)
+    finally:
+        await conn.close()
+
+
+async def run_step(users, args):
+    stats = Stats()
+    tasks = [asyncio.ensure_future(Labeler(i, args, stats).run()) for i in range(users)]
+    tasks.append(asyncio.ensure_future(sample_pool(args, stats)))
+
+    await asyncio.sleep(args.warmup)
+    stats.recording = True
+    st = time.perf_counter()
+    await asyncio.sleep(args.duration)
+    stats.recording = False
+    elapsed = time.perf_counter() - st
+
+    for t in tasks:
+        t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return stats.report(users, elapsed)
+
+
+# ---------------------------------------------------------------------------- local stack
+def wait_for(url, proc, timeout=60):
+    st = time.time()
+    while time.time() - st < timeout:
+        if proc.poll() is not None:
+            raise RuntimeError(f'{url} exited with {proc.returncode}')
+        try:
+            with urllib.request.urlopen(url, timeout=1) as resp:
+                resp.read()
+                return
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.1)
+    raise TimeoutError(url)
+
+
+def tiff(width, height, pixels):
+    """
+    uncompressed 8 bit grayscale tiff, so seeding needs no imaging library
+    """
+    entries = ((256, 4, width), (257, 4, height), (258, 3, 8), (259, 3, 1), (262, 3, 1),
+               (273, 4, 8), (277, 3, 1), (278, 4, height), (279, 4, len(pixels)))
+    ifd = struct.pack('<H', len(entries))
+    offset = 8 + len(pixels)
+    for tag, typ, value in entries:
+        if typ == 3:
+            ifd += struct.pack('<HHIHH', tag, typ, 1, value, 0)
+        else:
+            ifd += struct.pack('<HHII', tag, typ, 1, value)
+    ifd += struct.pack('<I', 0)
+    return b'II*\x00' + struct.pack('<I', offset) + pixels + ifd
+
+
+def seed_images(args, n):
+    import base64
+
+    paths = sorted(glob.glob(os.path.join(ROOT, 'api', 'data', '*', '*.tif')))
+    rng = random.Random(args.seed)
+    for i in range(n):
+        if i < len(paths):
+            with open(paths[i], 'rb') as rfile:
+                buf = rfile.read()
+        else:
+            buf = tiff(300, 300, bytes(rng.getrandbits(8) for _ in range(300 * 300)))
+
+        payload = {'image': base64.b64encode(buf).decode(), 'loadname': 'loadtest', 'trayname': 'loadtest',
+                   'hole_id': i, 'zoom_level': 1.0}
+        req = urllib.request.Request(f'{args.api}/add_unclassified_image', data=json.dumps(payload).encode(),
+                                     headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(req) as resp:
+            resp.read()
+
+
+def start_stack(args):
+    env = bench_env(args.backend)
+    procs = []
+
+    if args.backend == 'sqlite':
+        subprocess.run([sys.executable, '-c',
+                        'from api.models import Base; from api.session import get_engine; '
+                        'Base.metadata.create_all(get_engine())'], cwd=ROOT, env=env, check=True)
+    subprocess.run([sys.executable, '-m', 'api.db'], cwd=ROOT, env=env, check=True,
+                   stdout=subprocess.DEVNULL)
+
+    port = free_port()
+    args.api = f'http://127.0.0.1:{port}'
+    proc = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'api.main:app', '--port', str(port),
+                             '--workers', str(args.workers)],
+                            cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    procs.append(proc)
+    wait_for(f'{args.api}/health', proc)
+    seed_images(args, args.images)
+
+    if args.target == 'frontend':
+        port = free_port()
+        args.frontend = f'http://127.0.0.1:{port}'
+        env = dict(env, API_URL=args.api)
+        proc = subprocess.Popen([sys.executable, '-m', 'gunicorn', 'frontend.main:app', '-b', f'127.0.0.1:{port}',
+                                 '--workers', str(args.workers), '--threads', '8'],
+                                cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        procs.append(proc)
+        wait_for(args.frontend, proc)
+    return procs
+
+
+# ---------------------------------------------------------------------------- report
+def git_version():
+    p = subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=ROOT, capture_output=True, text=True)
+    return p.stdout.strip() or None
+
+
+def print_curve(curve):
+    print(f"{'users':>6}{'clicks/s':>10}{'req/s':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'err %':>8}{'pool':>7}")
+    for s in curve['steps']:
+        c = s['click']
+        print(f"{s['users']:6d}{s['clicks_per_s']:10.2f}{s['requests_per_s']:9.1f}"
+              f"{_fmt(c['p50_ms'])}{_fmt(c['p95_ms'])}{_fmt(c['p99_ms'])}"
+              f"{s['error_rate'] * 100:8.2f}{_fmt(s['db_pool']['checkedout_max'], 7, 0)}")
+
+
+def print_endpoints(step):
+    print(f"\nendpoints at {step['users']} users (ms)")
+    for name, e in step['endpoints'].items():
+        print(f"  {name:<26}{e['count']:8d}{_fmt(e['p50_ms'])}{_fmt(e['p95_ms'])}{_fmt(e['p99_ms'])}"
+              f"  errors={step['errors'].get(name, 0)}")
+
+
+def _fmt(v, width=9, digits=1):
+    return f'{"-":>{width}}' if v is None else f'{v:{width}.{digits}f}'
+
+
+def compare(old_path, new_path):
+    with open(old_path) as rfile:
+        old = json.load(rfile)
+    with open(new_path) as rfile:
+        new = json.load(rfile)
+
+    print(f"old {old_path} {old['meta'].get('version')}  new {new_path} {new['meta'].get('version')}")
+    print(f"{'users':>6}{'clicks/s old':>14}{'new':>9}{'p95 old':>10}{'new':>9}{'err% old':>10}{'new':>8}")
+    steps = {s['users']: s for s in old['steps']}
+    for s in new['steps']:
+        o = steps.get(s['users'])
+        if o is None:
+            continue
+        print(f"{s['users']:6d}{o['clicks_per_s']:14.2f}{s['clicks_per_s']:9.2f}"
+              f"{_fmt(o['click']['p95_ms'], 10)}{_fmt(s['click']['p95_ms'])}"
+              f"{o['error_rate'] * 100:10.2f}{s['error_rate'] * 100:8.2f}")
+
+
+async def run(args):
+    steps = []
+    for users in args.users:
+        step = await run_step(users, args)
+        steps.append(step)
+        c = step['click']
+        print(f"{users:4d} labelers  {step['clicks_per_s']:7.2f} clicks/s  p95={c['p95_ms']} ms  "
+              f"errors={step['error_rate'] * 100:.2f}%", file=sys.stderr)
+    return steps
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', default='1,2,4,8,16,32',
+                        type=lambda s: [int(u) for u in s.split(',')], help='comma separated labeler counts')
+    parser.add_argument('--duration', type=float, default=20, help='measured seconds per step')
+    parser.add_argument('--warmup', type=float, default=3, help='unmeasured seconds before every step')
+    parser.add_argument('--think', type=float, default=2, help='mean seconds between clicks')
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--target', choices=('api', 'frontend'), default='api')
+    parser.add_argument('--api', default=os.getenv('API_URL', 'http://localhost:8000'))
+    parser.add_argument('--frontend', default='http://localhost:8051')
+    parser.add_argument('--no-reports', dest='reports', action='store_false',
+                        help='skip the report requests, the frontend gets those pushed over /events')
+    parser.add_argument('--pool-interval', type=float, default=0.25)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--start', action='store_true', help='launch a local API (and frontend) to test')
+    parser.add_argument('--backend', choices=('sqlite', 'env'), default='sqlite')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--images', type=int, default=200, help='images to seed with --start')
+    parser.add_argument('--out', help='write the saturation curve json here')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two curve files')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    procs = start_stack(args) if args.start else []
+    try:
+        steps = asyncio.run(run(args))
+    finally:
+        for p in procs:
+            p.terminate()
+            p.wait()
+
+    curve = {'meta': {'version': git_version(),
+                      'date': datetime.now().isoformat(timespec='seconds'),
+                      'target': args.target,
+                      'think_s': args.think,
+                      'duration_s': args.duration,
+                      'workers': args.workers if args.start else None,
+                      'backend': args.backend if args.start else None,
+                      'reports': args.reports},
+             'steps': steps}
+
+    print_curve(curve)
+    if steps:
+        print_endpoints(steps[-1])
+    if args.out:
+        with open(args.out, 'w') as wfile:
+            json.dump(curve, wfile, indent=2)
+
+
+if __name__ == '__main__':
+    main()
+# ============= EOF =============================================
@@ -0,0 +1,109 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+"""
+response encoding benchmark
+
+    python bench/serialization.py [--number 50]
+
+builds payloads shaped like the API responses and reports encode time and payload size for
+stdlib json (the previous JSONResponse path, base64 for bytes), orjson and msgpack
+"""
+import argparse
+import base64
+import glob
+import json
+import os
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from api.responses import ORJSONResponse, MsgPackResponse  # noqa: E402
+
+
+def sample_images(n):
+    paths = sorted(glob.glob(os.path.join(ROOT, 'api', 'data', '*', '*.tif')))[:n]
+    bufs = []
+    for p in paths:
+        with open(p, 'rb') as rfile:
+            bufs.append(rfile.read())
+    return bufs or [os.urandom(500000) for _ in range(n)]
+
+
+def payloads():
+    labels = ('good', 'empty', 'multigrain', 'contaminant')
+    images = sample_images(len(labels))
+
+    rows = [{'id': i, 'hashid': f'{i:064x}', 'loadname': 'test148', 'trayname': '421-hole',
+             'hole_id': i % 421, 'sample': 'foo', 'material': 'sanidine', 'project': None,
+             'identifier': '1000', 'zoom_level': 1.0, 'nxtals': None, 'weight': None, 'note': None,
+             'create_date': '2023-03-01T12:00:00'} for i in range(1000)]
+
+    return {'/representative_images': [{'label': l, 'image': b} for l, b in zip(labels, images)],
+            '/scoreboard': {'table': [{'name': f'user{i}', 'total': 1000 - i, 'badges': ['😎']}
+                                      for i in range(50)]},
+            '/results_report': {'table': [{'label': l, 'count': 100} for l in labels],
+                                'consensus': [{'label': l, 'count': 90} for l in labels],
+                                'total': 100000, 'unclassified': 99600},
+            '/images?limit=1000': {'table': rows, 'next': 1000},
+            '/similar/{id}?k=50': {'image_id': 1, 'table': [{'id': i, 'hashid': f'{i:064x}', 'score': 0.5}
+                                                           for i in range(50)]}}
+
+
+def _b64(obj):
+    if isinstance(obj, bytes):
+        return base64.b64encode(obj).decode()
+    raise TypeError
+
+
+def stdlib_json(content):
+    # what starlette.JSONResponse.render did, with the base64 step the endpoints used to do
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(',', ':'),
+                      default=_b64).encode('utf-8')
+
+
+def orjson_(content):
+    return ORJSONResponse(content).body
+
+
+def msgpack_(content):
+    return MsgPackResponse(content).body
+
+
+ENCODERS = (('json', stdlib_json), ('orjson', orjson_), ('msgpack', msgpack_))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--number', type=int, default=50)
+    args = parser.parse_args()
+
+    print(f"{'endpoint':<24}{'encoder':<10}{'encode ms':>12}{'bytes':>12}{'vs json':>10}")
+    for endpoint, content in payloads().items():
+        base = None
+        for name, func in ENCODERS:
+            body = func(content)
+            t = timeit.timeit(lambda: func(content), number=args.number) / args.number
+            if base is None:
+                base = len(body)
+            print(f'{endpoint:<24}{name:<10}{t * 1000:12.3f}{len(body):12d}{len(body) / base:10.2f}')
+        print()
+
+
+if __name__ == '__main__':
+    main()
+# ============= EOF =============================================
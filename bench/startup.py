@@ -0,0 +1,148 @@
+# ===============================================================================
+# Copyright 2023 ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+"""
+API startup benchmark
+
+    python bench/startup.py [--runs 5] [--path /health] [--backend sqlite]
+
+reports the wall time of `import api.main` in a fresh interpreter, the slowest modules from
+`python -X importtime`, and the time from spawning uvicorn to the first successful response.
+the default sqlite backend uses a throwaway database so no postgres service is needed, use
+--backend env to keep the database settings of the environment
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_SNIPPET = ('import time; t = time.perf_counter(); import api.main; '
+                  'print(time.perf_counter() - t)')
+
+
+ENV = dict(os.environ)
+
+
+def bench_env(backend):
+    env = dict(os.environ)
+    if backend == 'sqlite':
+        tmp = tempfile.mkdtemp(prefix='trayclassifier-bench-')
+        env.pop('DATABASE_URL', None)
+        env.update(DB_BACKEND='sqlite',
+                   SQLITE_PATH=os.path.join(tmp, 'bench.db'),
+                   BLOB_DIR=os.path.join(tmp, 'blobs'),
+                   TILE_DIR=os.path.join(tmp, 'tiles'),
+                   FEATURE_PATH=os.path.join(tmp, 'features.f32'))
+    return env
+
+
+def run_python(args, **kw):
+    return subprocess.run([sys.executable] + args, cwd=ROOT, capture_output=True, text=True, env=ENV, **kw)
+
+
+def import_time(runs):
+    ts = []
+    for _ in range(runs):
+        p = run_python(['-c', IMPORT_SNIPPET], check=True)
+        ts.append(float(p.stdout.strip().splitlines()[-1]))
+    return ts
+
+
+def slowest_imports(n=10):
+    p = run_python(['-X', 'importtime', '-c', 'import api.main'], check=True)
+    rows = []
+    for line in p.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative, name = line[len('import time:'):].split('|')
+        rows.append((int(cumulative), int(self_us), name.strip()))
+    return sorted(rows, reverse=True)[:n]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def time_to_first_response(path, timeout=60):
+    port = free_port()
+    url = f'http://127.0.0.1:{port}{path}'
+    st = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'api.main:app', '--port', str(port)],
+                            cwd=ROOT, env=ENV, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - st < timeout:
+            if proc.poll() is not None:
+                raise RuntimeError(f'uvicorn exited with {proc.returncode}')
+            try:
+                with urllib.request.urlopen(url, timeout=1) as resp:
+                    resp.read()
+                    return time.perf_counter() - st
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.01)
+        raise TimeoutError(url)
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--path', default='/health')
+    parser.add_argument('--json', action='store_true', help='print a single json result line')
+    parser.add_argument('--backend', choices=('sqlite', 'env'), default='sqlite')
+    args = parser.parse_args()
+
+    global ENV
+    ENV = bench_env(args.backend)
+
+    its = import_time(args.runs)
+    slow = slowest_imports()
+    ttfr = [time_to_first_response(args.path) for _ in range(args.runs)]
+
+    result = {'import_median_s': statistics.median(its),
+              'import_min_s': min(its),
+              'ttfr_median_s': statistics.median(ttfr),
+              'ttfr_min_s': min(ttfr),
+              'path': args.path,
+              'backend': args.backend,
+              'runs': args.runs}
+    if args.json:
+        print(json.dumps(result))
+        return
+
+    print(f"import api.main     median={result['import_median_s'] * 1000:8.1f} ms  "
+          f"min={result['import_min_s'] * 1000:8.1f} ms")
+    print(f"first response {args.path:<6} median={result['ttfr_median_s'] * 1000:8.1f} ms  "
+          f"min={result['ttfr_min_s'] * 1000:8.1f} ms")
+    print('\nslowest imports (cumulative us, self us)')
+    for cumulative, self_us, name in slow:
+        print(f'{cumulative:10d} {self_us:10d}  {name}')
+
+
+if __name__ == '__main__':
+    main()
+# ============= EOF =============================================
@@ -0,0 +1,57 @@
+/*
+ deep zoom image viewer. handle_image puts an OpenSeadragon tile source in the deepzoom_source
+ store, the viewer fetches only the tiles in view directly from the api.
+
+ the viewer is made once and reused for every image. the Classify tab is unmounted while
+ another tab is shown, so a viewer whose element left the page is replaced
+*/
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    deepzoom: {
+        show: function (source, active_tab) {
+            if (!source || active_tab !== 'classify' || typeof OpenSeadragon === 'undefined') {
+                return window.dash_clientside.no_update;
+            }
+
+            const element = document.getElementById('deepzoom');
+            if (!element) {
+                return window.dash_clientside.no_update;
+            }
+
+            let viewer = window.deepzoomViewer;
+            if (viewer && viewer.element !== element) {
+                viewer.destroy();
+                viewer = null;
+            }
+
+            if (!viewer) {
+                viewer = OpenSeadragon({
+                    element: element,
+                    prefixUrl: source.prefix_url,
+                    showNavigator: true,
+                    navigatorPosition: 'BOTTOM_RIGHT',
+                    maxZoomPixelRatio: 4,
+                    visibilityRatio: 1,
+                    constrainDuringPan: true,
+                    // keep decoded tiles around so panning back is instant
+                    maxImageCacheCount: 400,
+                    imageLoaderLimit: 6,
+                    immediateRender: false,
+                    timeout: 60000
+                });
+                window.deepzoomViewer = viewer;
+                window.deepzoomHashid = null;
+            }
+
+            if (window.deepzoomHashid !== source.hashid) {
+                // an image the api could not tile leaves the viewer empty, not on the last image
+                if (source.tile_source) {
+                    viewer.open(source.tile_source);
+                } else {
+                    viewer.close();
+                }
+                window.deepzoomHashid = source.hashid;
+            }
+            return source.hashid;
+        }
+    }
+});
@@ -16,21 +16,32 @@
 # ===============================================================================
 import base64
 import io
+import json
+import os
 import pprint
 import random
+import threading
+import time
 
-from dash import Dash, Input, Output, html, dcc, State, ctx
+from dash import Dash, Input, Output, html, dcc, State, ctx, no_update, ClientsideFunction
 from dash.dash_table import DataTable
 import dash_bootstrap_components as dbc
 import plotly.express as px
 import plotly.graph_objects as go
+import msgpack
 import requests
 from PIL import Image
 from numpy import array, hstack, zeros, ones
 
+# deep zoom viewer, the glue is in assets/deepzoom.js
+OPENSEADRAGON_URL = os.getenv('OPENSEADRAGON_URL',
+                              'https://cdn.jsdelivr.net/npm/openseadragon@4.1/build/openseadragon/')
+
 dash_app = Dash(
     'tray_classifier',
     external_stylesheets=[dbc.themes.BOOTSTRAP],
+    external_scripts=[f'{OPENSEADRAGON_URL}openseadragon.min.js'],
+    assets_folder=os.path.join(os.path.dirname(__file__), 'assets'),
     title="Tray Classifier Tool",
     # background_callback_manager=background_callback_manager,
 )
@@ -43,7 +54,9 @@ cols_scoreboard_table = [{'name': 'Name', 'id': 'name'},
 
 cols_image_table = [{'name': 'Name', 'id': 'name'},
                     {'name': 'Value', 'id': 'value'}]
-baseurl = 'http://api:8000'
+baseurl = os.getenv('API_URL', 'http://api:8000')
+# the api as the browser sees it, tiles are loaded straight from there
+public_url = os.getenv('PUBLIC_API_URL', 'http://localhost:8000')
 
 # LABELS = ('good', 'empty', 'multigrain', 'contaminant', 'blurry')
 LABELS = ('good', 'empty', 'multigrain', 'contaminant')
@@ -88,14 +101,16 @@ countbox_style = {'border': 'solid',
                   'border-radius': '10px',
                   }
 
-dash_app.layout = html.Div(dbc.Container([
-    dcc.ConfirmDialog(
-        id='confirm-danger',
-        message='Please enter a Username',
-    ),
-    dbc.Row(dbc.Col(html.H1('R-Hole'),
-                    className='col-md-auto'),
-            className='justify-content-center'),
+def make_tray_review():
+    return [dbc.Row([dbc.Col(dcc.Dropdown(id='tray_select', placeholder='Select a tray'), width=6),
+                     dbc.Col(html.Div(id='tray_info'), width=6)],
+                    style={'margin-top': '10px', 'margin-bottom': '10px'}),
+            dcc.Graph(id='tray_mosaic', config=graph_config)]
+
+
+graph_config = {'responsive': False, "displayModeBar": False, "displaylogo": False}
+
+classify_tab = [
     dbc.Row([dbc.Col(html.H3('Images')),
              dbc.Col(html.Div(html.H3(id='total_info', style={'color': 'green',
                                                               'margin': '5px'
@@ -147,7 +162,9 @@ dash_app.layout = html.Div(dbc.Container([
                                       'border-radius': '5px',
                                       'margin': '10px'
                                       }),
-                      html.Div(id="image"), ]),
+                      html.Div(id='deepzoom', style={'height': '480px'}),
+                      dcc.Store(id='deepzoom_source'),
+                      dcc.Store(id='deepzoom_shown')]),
              dbc.Col([
                  dbc.Row([dbc.Col([html.H2('Image'),
                           make_table(cols_image_table,
@@ -158,24 +175,99 @@ dash_app.layout = html.Div(dbc.Container([
                  html.H2('Leader Board'),
                  make_table(cols_scoreboard_table,
                             'scoreboard_table')])
-             ])]),
+             ])]
+
+dash_app.layout = html.Div(dbc.Container([
+    dcc.ConfirmDialog(
+        id='confirm-danger',
+        message='Please enter a Username',
+    ),
+    dbc.Row(dbc.Col(html.H1('R-Hole'),
+                    className='col-md-auto'),
+            className='justify-content-center'),
+    dbc.Tabs([dbc.Tab(classify_tab, label='Classify', tab_id='classify'),
+              dbc.Tab(make_tray_review(), label='Tray Review', tab_id='tray_review')],
+             id='tabs', active_tab='classify'),
+    dcc.Interval(id='updates_interval', interval=1000),
+    dcc.Store(id='updates_version')]),
     style={'backgroundColor': '#e3cc9e'}
 )
 
-graph_config = {'responsive': False, "displayModeBar": False, "displaylogo": False}
+
+class Updates:
+    """
+    keeps the latest counts and scoreboard pushed by the api's /events stream. one subscription
+    per frontend process, the browser callbacks read from here instead of querying the api
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.counts = None
+        self.scoreboard = {}
+        self.version = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def get(self):
+        with self._lock:
+            return self.version, self.counts, list(self.scoreboard.values())
+
+    def _run(self):
+        while 1:
+            try:
+                self._listen()
+            except (requests.RequestException, ValueError) as e:
+                print('event stream lost', e)
+            time.sleep(1)
+
+    def _listen(self):
+        with requests.get(self.url, stream=True, timeout=(5, 60)) as resp:
+            kind, data = None, []
+            for line in resp.iter_lines(decode_unicode=True):
+                if line.startswith('event:'):
+                    kind = line[6:].strip()
+                elif line.startswith('data:'):
+                    data.append(line[5:].strip())
+                elif not line and data:
+                    self._apply(kind, json.loads(''.join(data)))
+                    kind, data = None, []
+
+    def _apply(self, kind, data):
+        with self._lock:
+            if kind == 'snapshot':
+                self.scoreboard = {}
+            if 'counts' in data:
+                self.counts = data['counts']
+            for row in data.get('scoreboard', ()):
+                self.scoreboard[row['name']] = row
+            self.version += 1
+
+
+updates = Updates(f'{baseurl}/events')
+
+
+def get_msgpack(url):
+    """
+    use msgpack for image bearing responses, bytes fields come back raw instead of base64
+    """
+    resp = requests.get(url, headers={'Accept': 'application/msgpack'})
+    return msgpack.unpackb(resp.content, raw=False)
 
 
 def make_example_graphs():
     url = f'{baseurl}/representative_images'
-    resp = requests.get(url)
-    images_obs = resp.json()
+    images_obs = get_msgpack(url)
 
     imgs = []
     for l in LABELS:
         for i in images_obs:
             if i['label'] == l:
-                buf = base64.b64decode(i['image'].encode())
-                img = Image.open(io.BytesIO(buf))
+                img = Image.open(io.BytesIO(i['image']))
                 imgs.append(img)
                 break
         else:
@@ -244,18 +336,35 @@ def make_image_table(obj):
     return data
 
 
+def make_tile_source(hashid):
+    """
+    the image's deep zoom descriptor with the tile url rewritten for the browser, the viewer
+    only downloads the tiles in view
+    """
+    source = None
+    resp = requests.get(f'{baseurl}/tiles/{hashid}.json')
+    if resp.status_code == 200:
+        source = resp.json()
+        source['Image']['Url'] = f'{public_url}/tiles/{hashid}_files/'
+    else:
+        print('no tiles for', hashid, resp.text)
+    return {'hashid': hashid, 'tile_source': source, 'prefix_url': f'{OPENSEADRAGON_URL}images/'}
+
+
+dash_app.clientside_callback(ClientsideFunction(namespace='deepzoom', function_name='show'),
+                             Output('deepzoom_shown', 'data'),
+                             [Input('deepzoom_source', 'data'),
+                              Input('tabs', 'active_tab')])
+
+
 def make_label_guess(im):
     # class image using a prebuilt classifier
     return random.choice(LABELS)
 
 
-@dash_app.callback([Output('image', 'children'),
+@dash_app.callback([Output('deepzoom_source', 'data'),
                     Output('image_id', 'children'),
-                    Output('results_table', 'data'),
-                    Output('total_info', 'children'),
-                    Output('unclassified_info', 'children'),
                     # Output('image_info', 'children'),
-                    Output('scoreboard_table', 'data'),
                     Output('good_graph', 'children'),
                     Output('empty_graph', 'children'),
                     Output('multigrain_graph', 'children'),
@@ -273,13 +382,12 @@ def make_label_guess(im):
                        Input('contaminant_btn', 'n_clicks'),
                        State('image_id', 'children'),
                        State('username', 'value'),
-                       State('image', 'children'),
                        State('image_table', 'data'),
                    ],
                    )
 def handle_image(good_n_clicks, skip_n_clicks, empty_n_clicks, multigrain_n_clicks,
                  contaminant_n_clicks, current_image_id, username,
-                 efig, image_tabledata):
+                 image_tabledata):
     display_confirm = False
     if ctx.triggered_id in ('good_btn', 'empty_btn',
                             'multigrain_btn',
@@ -294,20 +402,6 @@ def handle_image(good_n_clicks, skip_n_clicks, empty_n_clicks, multigrain_n_clic
             # else:
             #     requests.post(f'{baseurl}/label/{current_image_id}?label={label}')
 
-    resp = requests.get(f'{baseurl}/results_report')
-    report = resp.json()
-    tabledata = report['table']
-
-    url = f'{baseurl}/scoreboard'
-    if username:
-        url = f'{url}?user={username}'
-    resp = requests.get(url)
-    scoreboard_tabledata = resp.json()['table']
-
-    # results_info = f"Total= {report['total']} Unclassified= {report['unclassified']}"
-    total_info = f"Total= {report['total']}"
-    unclassified_info = f"Unclassified= {report['unclassified']}"
-
     obj = None
     if not display_confirm:
         url = f'{baseurl}/unclassified_image_info'
@@ -317,7 +411,7 @@ def handle_image(good_n_clicks, skip_n_clicks, empty_n_clicks, multigrain_n_clic
         resp = requests.get(url)
         obj = resp.json()
 
-    graph = dcc.Graph(config=graph_config)
+    source = no_update
     # image_info = ''
     image_id = 0
 
@@ -325,28 +419,11 @@ def handle_image(good_n_clicks, skip_n_clicks, empty_n_clicks, multigrain_n_clic
 
     if obj:
         image_id = obj['id']
-        hid = obj['hashid']
-        resp = requests.get(f'{baseurl}/unclassified_image?hashid={hid}')
-        # print(resp, resp.text)
-        img = Image.open(io.BytesIO(resp.content))
-        img = array(img)
-        fig = px.imshow(img,
-                        # color_continuous_scale='gray'
-                        )
-
-        fig.update_layout(coloraxis_showscale=False,
-                          paper_bgcolor='#e3cc9e',
-                          # margin=dict(l=20, r=20, t=20, b=20),
-                          margin=dict(l=0, r=0, t=0, b=0),
-                          height=480)
-        fig.update_xaxes(showticklabels=False)
-        fig.update_yaxes(showticklabels=False)
-        graph.figure = fig
+        source = make_tile_source(obj['hashid'])
         image_table = make_image_table(obj)
-        label_guess = make_label_guess(img)
+        label_guess = make_label_guess(obj)
 
     else:
-        graph = efig
         image_table = image_tabledata
 
     label_guess = f"R-Hole's guess:  {label_guess}"
@@ -355,12 +432,103 @@ def handle_image(good_n_clicks, skip_n_clicks, empty_n_clicks, multigrain_n_clic
     users = resp.json()
     available_users = [html.Option(value=word['name']) for word in users]
 
-    return graph, image_id, \
-        tabledata, total_info, unclassified_info, scoreboard_tabledata, \
+    return source, image_id, \
         good_graph, empty_graph, multigrain_graph, contaminant_graph, \
         image_table, display_confirm, label_guess, available_users
 
 
+@dash_app.callback([Output('results_table', 'data'),
+                    Output('total_info', 'children'),
+                    Output('unclassified_info', 'children'),
+                    Output('scoreboard_table', 'data'),
+                    Output('updates_version', 'data')],
+                   [Input('updates_interval', 'n_intervals'),
+                    Input('username', 'value'),
+                    State('updates_version', 'data')])
+def handle_updates(n_intervals, username, current_version):
+    """
+    counts and leader board come from the pushed updates, nothing is sent to the browser unless
+    they changed or the username changed
+    """
+    updates.start()
+    version, report, scoreboard_tabledata = updates.get()
+    if report is None or (version == current_version and ctx.triggered_id == 'updates_interval'):
+        return no_update, no_update, no_update, no_update, no_update
+
+    tabledata = report['table']
+    # results_info = f"Total= {report['total']} Unclassified= {report['unclassified']}"
+    total_info = f"Total= {report['total']}"
+    unclassified_info = f"Unclassified= {report['unclassified']}"
+
+    scoreboard_tabledata = sorted(scoreboard_tabledata, key=lambda x: x['total'], reverse=True)
+    if username:
+        idx = next((i for i, r in enumerate(scoreboard_tabledata) if r['name'] == username), None)
+        if idx is not None:
+            row = scoreboard_tabledata.pop(idx)
+            scoreboard_tabledata.insert(0, row)
+
+    return tabledata, total_info, unclassified_info, scoreboard_tabledata, version
+
+
+def tray_key(loadname, trayname):
+    return json.dumps([loadname, trayname])
+
+
+@dash_app.callback(Output('tray_select', 'options'),
+                   Input('tabs', 'active_tab'))
+def handle_trays(active_tab):
+    if active_tab != 'tray_review':
+        return no_update
+
+    trays = get_msgpack(f'{baseurl}/trays')['table']
+    return [{'label': f"{t['loadname']} / {t['trayname']} ({t['count']})",
+             'value': tray_key(t['loadname'], t['trayname'])} for t in trays]
+
+
+@dash_app.callback([Output('tray_mosaic', 'figure'),
+                    Output('tray_info', 'children')],
+                   [Input('tray_select', 'value'),
+                    Input('updates_version', 'data'),
+                    State('tabs', 'active_tab')])
+def handle_tray_review(tray, version, active_tab):
+    """
+    the whole tray is one mosaic image from the api, the hole map only drives the hover text
+    """
+    if not tray or active_tab != 'tray_review':
+        return no_update, no_update
+
+    loadname, trayname = json.loads(tray)
+    params = {'loadname': loadname, 'trayname': trayname}
+    resp = requests.get(f'{baseurl}/tray_mosaic', params=params, headers={'Accept': 'application/msgpack'})
+    if resp.status_code != 200:
+        return go.Figure(), 'no images for this tray'
+    obj = msgpack.unpackb(resp.content, raw=False)
+
+    resp = requests.get(f'{baseurl}/tray_mosaic.png', params=params)
+    src = f'data:image/png;base64,{base64.b64encode(resp.content).decode()}'
+
+    w, h, c = obj['width'], obj['height'], obj['cell']
+    holes = obj['holes']
+    text = [f"hole {r['hole_id']}  id {r['id']}<br>{r['label'] or 'unlabeled'}"
+            f"{'  (%d votes, %.0f%%)' % (r['votes'], r['agreement'] * 100) if r['votes'] else ''}"
+            for r in holes]
+
+    fig = go.Figure(go.Scatter(x=[r['x'] + c / 2 for r in holes],
+                               y=[r['y'] + c / 2 for r in holes],
+                               mode='markers', marker={'opacity': 0, 'size': c},
+                               hovertext=text, hoverinfo='text'))
+    fig.add_layout_image(source=src, x=0, y=0, sizex=w, sizey=h, xref='x', yref='y',
+                         sizing='stretch', layer='below')
+    fig.update_xaxes(range=[0, w], showticklabels=False, showgrid=False, zeroline=False)
+    fig.update_yaxes(range=[h, 0], showticklabels=False, showgrid=False, zeroline=False,
+                     scaleanchor='x')
+    fig.update_layout(width=min(w, 1100), height=min(w, 1100) * h / w, margin=dict(l=0, r=0, t=0, b=0),
+                      paper_bgcolor='#e3cc9e', plot_bgcolor='#e3cc9e')
+
+    labeled = sum(1 for r in holes if r['label'])
+    return fig, f'{len(holes)} holes, {labeled} labeled'
+
+
 app = dash_app.server
 if __name__ == "__main__":
     dash_app.run_server(debug=True, port=8051)